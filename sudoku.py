@@ -1,58 +1,578 @@
+import math
 import os
-from collections import Counter
-from itertools import combinations
-from copy import deepcopy
+import sys
+from array import array
+from collections import deque, namedtuple
+from collections.abc import Mapping
+from functools import lru_cache, wraps
+from time import perf_counter
+
+
+# Boards have box_size x box_size boxes of box_size x box_size cells, so
+# box_size ** 2 digits; digits above 9 are written as A, B... or as numbers.
+BOX_SIZES = (2, 3, 4, 5)
+ROW_SIZES = tuple(b * b for b in BOX_SIZES)
+SYMBOLS = '0123456789ABCDEFGHIJKLMNOP'
+SYMBOL_VALUES = dict({symbol: value for value, symbol in enumerate(SYMBOLS)}, **{'.': 0})
+# Larger preemptive sets are not searched for, which only matters above 9 x 9
+# where the subsets of a unit get too many
+MAX_SET_SIZE = 4
+
+
+class Layout:
+    # Cells are numbered 0..size ** 2 - 1 row by row. The units (rows,
+    # columns, boxes) and peers of every cell, and the fixed parts of the
+    # LaTeX table, are built once per box size here instead of on every call.
+    def __init__(self, box_size):
+        b = box_size
+        n = b * b
+        self.box_size = b
+        self.size = n
+        self.all_digits = (1 << n) - 1
+        self.cells = range(n * n)
+        self.coordinates = tuple((c // n, c % n) for c in self.cells)
+        self.row_of = tuple(c // n for c in self.cells)
+        self.column_of = tuple(c % n for c in self.cells)
+        self.box_of = tuple(c // (n * b) * b + c % n // b for c in self.cells)
+        self.rows = tuple(tuple(c for c in self.cells if self.row_of[c] == k) for k in range(n))
+        self.columns = tuple(tuple(c for c in self.cells if self.column_of[c] == k) for k in range(n))
+        self.boxes = tuple(tuple(c for c in self.cells if self.box_of[c] == k) for k in range(n))
+        self.units = self.rows + self.columns + self.boxes
+        self.unit_types = ('row',) * n + ('column',) * n + ('box',) * n
+        self.unit_ids_of = tuple((self.row_of[c], n + self.column_of[c], 2 * n + self.box_of[c])
+                                 for c in self.cells)
+        self.units_of = tuple((self.rows[self.row_of[c]], self.columns[self.column_of[c]],
+                               self.boxes[self.box_of[c]]) for c in self.cells)
+        self.peers = tuple(tuple(sorted(set(sum(self.units_of[c], ())) - {c})) for c in self.cells)
+        # The same units as bitboards with bit c set for every cell c in them
+        self.row_bits = tuple(sum(1 << c for c in row) for row in self.rows)
+        self.column_bits = tuple(sum(1 << c for c in column) for column in self.columns)
+        self.box_bits = tuple(sum(1 << c for c in box) for box in self.boxes)
+        self.box_order = tuple(c for box in self.boxes for c in box)
+        self.box_coordinates = tuple(tuple(self.coordinates[c] for c in box) for box in self.boxes)
+        # The tabular, with double rules around the boxes, and what follows
+        # each cell in it. Boards above 9 x 9 are scaled down to the page.
+        columns = '||' + '||'.join(['|'.join(['@{}c@{}'] * b)] * b) + '||'
+        self.tex_head = '\\begin{center}\n'
+        self.tex_tail = '\\end{tabular}\n\\end{center}\n\n'
+        if n > 9:
+            self.tex_head += '\\resizebox{\\linewidth}{!}{%\n'
+            self.tex_tail = '\\end{tabular}}\n\\end{center}\n\n'
+        self.tex_head += '\\begin{tabular}{' + columns + '}\\hline\\hline\n'
+        self.tex_lines = tuple('% Line ' + str(i + 1) + '\n' for i in range(n))
+        self.tex_separators = tuple(' &\n' if j % b == b - 1 and j != n - 1 else
+                                    ' & ' if j != n - 1 else
+                                    ' \\\\ \\hline\\hline\n' if i == n - 1 else
+                                    ' \\\\ \\hline\\hline\n\n' if i % b == b - 1 else
+                                    ' \\\\ \\hline\n\n' for i, j in self.coordinates)
+
+
+@lru_cache(maxsize=None)
+def layout_for(box_size):
+    return Layout(box_size)
+
+
+# The tables of the 9 x 9 board
+LAYOUT = layout_for(3)
+ALL_DIGITS = LAYOUT.all_digits
+UNITS = LAYOUT.units
+UNIT_TYPES = LAYOUT.unit_types
+UNIT_IDS_OF = LAYOUT.unit_ids_of
+
+
+def digit_bit(num):
+    return 1 << (num - 1)
+
+
+def digits_of(mask):
+    # Digits whose bits are set in mask, in increasing order
+    digits = []
+    while mask:
+        low = mask & -mask
+        digits.append(low.bit_length())
+        mask ^= low
+    return digits
+
+
+def find_subsets(masks, k, stats=None):
+    # Yields (chosen, union) for every choice of k of the masks whose union
+    # has exactly k bits; chosen has bit p set when masks[p] is used. A
+    # branch is dropped as soon as its union has more than k bits.
+    items = [p for p, m in enumerate(masks) if m and m.bit_count() <= k]
+
+    def extend(start, size, chosen, union):
+        if size == k:
+            if union.bit_count() == k:
+                yield chosen, union
+            return
+        for idx in range(start, len(items) - (k - size) + 1):
+            p = items[idx]
+            u = union | masks[p]
+            if stats is not None:
+                stats.count('preemptive.combinations')
+            if u.bit_count() <= k:
+                yield from extend(idx + 1, size + 1, chosen | 1 << p, u)
+
+    return extend(0, 0, 0, 0)
+
+
+def timed(method):
+    # Times every call of method when the Sudoku has a stats object (see
+    # sudoku_stats); without one the call goes straight through.
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        stats = self.stats
+        if stats is None:
+            return method(self, *args, **kwargs)
+        stats.enter(name)
+        start = perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            stats.leave(name, perf_counter() - start)
+
+    return wrapper
 
 
 class SudokuError(Exception):
-    def __init__(self, message):
+    def __init__(self, message, line=None):
         self.message = message
+        # Line of the input where the bad puzzle starts, when reading a stream
+        self.line = line
+
+
+# Why a run stopped (see Sudoku.run)
+DONE = 'done'
+DEADLINE = 'deadline'
+STEPS = 'steps'
+CANCELLED = 'cancelled'
+# The max_nodes limit of the searches
+NODES = 'nodes'
+
+# The reason a run stopped and the state it left: a copy of the grid and
+# the marked and canceled digits of the cells as dicts
+Outcome = namedtuple('Outcome', ['reason', 'grid', 'marked', 'canceled'])
+
+
+class BudgetExceeded(SudokuError):
+    def __init__(self, reason):
+        super().__init__('Budget exceeded: ' + reason)
+        self.reason = reason
+
+
+class Budget:
+    # Limits on the work of a Sudoku: seconds of wall time from now, a
+    # number of steps (passes of force(), units searched by worked() and
+    # branches of the search), and a cancel token, any object with is_set()
+    # such as a threading.Event or a multiprocessing.Event set from
+    # elsewhere. Checked once per step; a BudgetExceeded is raised with the
+    # first reason found.
+    def __init__(self, seconds=None, steps=None, cancel=None):
+        self.deadline = None if seconds is None else perf_counter() + seconds
+        self.steps = steps
+        self.cancel = cancel
+        self.taken = 0
+
+    def step(self):
+        self.taken += 1
+        if self.cancel is not None and self.cancel.is_set():
+            raise BudgetExceeded(CANCELLED)
+        if self.steps is not None and self.taken > self.steps:
+            raise BudgetExceeded(STEPS)
+        if self.deadline is not None and perf_counter() > self.deadline:
+            raise BudgetExceeded(DEADLINE)
+
+
+def budgeted(method):
+    # Lets method take a budget=Budget(...) keyword, kept on the Sudoku
+    # while it runs so that the methods it calls spend from it as well
+    @wraps(method)
+    def wrapper(self, *args, budget=None, **kwargs):
+        if budget is None:
+            return method(self, *args, **kwargs)
+        saved = self.budget
+        self.budget = budget
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.budget = saved
+
+    return wrapper
+
+
+# Techniques recorded in the journal, and their names
+BY_SEARCH = 0
+BY_FORCE = 1
+BY_SINGLETON = 2
+BY_NAKED_SET = 3
+BY_HIDDEN_SET = 4
+BY_MARKING = 5
+TECHNIQUES = ('search', 'force', 'singleton', 'naked set', 'hidden set', 'marking')
+# A journal record packs cell << 12 | technique << 8 | flags | digit, where
+# the flags tell a placement from an elimination and the first record of a
+# step (a placement with the eliminations it causes, the eliminations of a
+# preemptive set, or the marking of the candidates) from the others
+PLACED = 1 << 6
+STEP_START = 1 << 7
+
+
+def unpack_record(record):
+    # (cell, digit, technique, placed, starts a step) of a journal record
+    return record >> 12, record & 63, record >> 8 & 15, bool(record & PLACED), bool(record & STEP_START)
+
+
+# LaTeX document parts, built once. A document is LATEX_PREAMBLE, then for
+# each puzzle the tex_head of its layout, the body and the tex_tail
+# (separated by LATEX_NEW_PAGE), then LATEX_END.
+LATEX_PREAMBLE = '\n'.join(['\\documentclass[10pt]{article}',
+                            '\\usepackage[left=0pt,right=0pt]{geometry}',
+                            '\\usepackage{tikz}',
+                            '\\usetikzlibrary{positioning}',
+                            '\\usepackage{cancel}',
+                            '\\pagestyle{empty}\n',
+                            '\\newcommand{\\N}[5]{\\tikz{\\node[label=above left:{\\tiny #1},',
+                            '                               label=above right:{\\tiny #2},',
+                            '                               label=below left:{\\tiny #3},',
+                            '                               label=below right:{\\tiny #4}]{#5};}}\n',
+                            '\\begin{document}\n',
+                            '\\tikzset{every node/.style={minimum size=.5cm}}\n',
+                            ''])
+LATEX_NEW_PAGE = '\\newpage\n\n'
+LATEX_END = '\\end{document}\n'
+# What each output mode renders
+TEX_BODIES = {'bare': 'bare', 'forced': 'bare', 'marked': 'marked', 'worked': 'worked'}
+# Bump whenever the documents produced for a given puzzle and mode change,
+# whether through the rendering or through the solving techniques, so that
+# cached documents are not reused
+TEX_VERSION = 1
+
+
+@lru_cache(maxsize=1 << 16)
+def tex_cell(marked, canceled, num, size=9):
+    # \N macro of a cell showing the digits of marked, the digits of canceled
+    # struck out, and num unless it is 0. The digits are split between the
+    # four labels of the macro in runs of size // 4 (1-2, 3-4, 5-6 and 7-9
+    # for 9 digits), the last label taking the rest.
+    quadrants = [[], [], [], []]
+    run = max(1, size // 4)
+    for d in range(1, size + 1):
+        if marked & digit_bit(d):
+            quadrants[min(3, (d - 1) // run)].append(str(d))
+        if canceled & digit_bit(d):
+            quadrants[min(3, (d - 1) // run)].append('\\cancel{' + str(d) + '}')
+    return '\\N' + ''.join('{' + ' '.join(q) + '}' for q in quadrants) + '{' + (str(num) if num else '') + '}'
+
+
+def write_tex_document(out, sudokus, mode):
+    # Renders each puzzle, after doing the work of mode on it, on a page of
+    # its own in a single document written to the file-like out
+    parts = [LATEX_PREAMBLE]
+    for k, sudoku in enumerate(sudokus):
+        sudoku.prepare(mode)
+        if k:
+            parts.append(LATEX_NEW_PAGE)
+        parts.append(sudoku.layout.tex_head)
+        sudoku.tex_body(parts, mode)
+        parts.append(sudoku.layout.tex_tail)
+        if len(parts) > 1024:
+            out.write(''.join(parts))
+            parts = []
+    parts.append(LATEX_END)
+    out.write(''.join(parts))
+
+
+def split_cells(line):
+    # The cells of a line of a puzzle: its words when they are numbers of up
+    # to two digits, some of two (as in 0 12 0 3 on a 16 x 16 board), else
+    # its characters other than blanks. A # starts a comment, so that a
+    # line holding only one reads as blank.
+    words = line.split('#', 1)[0].split()
+    if any(len(word) > 1 for word in words) and all(len(word) <= 2 for word in words):
+        return words
+    return list(''.join(words))
+
+
+def read_puzzles(lines, name='puzzle', on_error=None):
+    # Lazily yields a Sudoku for each puzzle read from an open file, stdin or
+    # any iterable of lines, holding at most one puzzle at a time. A puzzle
+    # is either a line of n * n cells or n lines of n cells, n being 9, 16,
+    # 25 (or 4, on several lines only), with 0 or . for the empty cells. A
+    # blank line ends the puzzle before it, if any. A bad puzzle is skipped
+    # and reported as a SudokuError carrying the line it starts on, passed
+    # to on_error or else printed to stderr; when a row of it is bad, the
+    # lines up to the next blank one are skipped with it, so that the rows
+    # of a puzzle never end up in another. Puzzles are named name_1,
+    # name_2...
+    count = 0
+    rows = []
+    start = 0
+    skipping = False
+    for number, line in enumerate(lines, 1):
+        cells = split_cells(line)
+        if not cells:
+            if rows:
+                report_bad_puzzle(SudokuError('Incomplete puzzle', start), on_error)
+                rows = []
+            skipping = False
+            continue
+        if skipping:
+            continue
+        if rows and len(cells) != len(rows[0]):
+            message = 'Line ' + str(number) + ' has ' + str(len(cells)) + ' cells instead of ' + str(len(rows[0]))
+            report_bad_puzzle(SudokuError(message, start), on_error)
+            rows = []
+            skipping = True
+            continue
+        if not rows:
+            start = number
+        if rows or len(cells) in ROW_SIZES:
+            rows.append(cells)
+            if len(rows) < len(cells):
+                continue
+            puzzle, rows = rows, []
+        else:
+            size = math.isqrt(len(cells))
+            if size * size != len(cells) or size not in ROW_SIZES:
+                report_bad_puzzle(SudokuError('Incorrect length: ' + str(len(cells)) + ' cells', start), on_error)
+                # A bad row of a puzzle on several lines takes the rest of
+                # that puzzle with it
+                skipping = len(cells) < ROW_SIZES[-1]
+                continue
+            puzzle = [cells[i:i + size] for i in range(0, len(cells), size)]
+        count += 1
+        try:
+            yield Sudoku.from_rows(puzzle, name + '_' + str(count))
+        except SudokuError as e:
+            report_bad_puzzle(SudokuError(e.message, start), on_error)
+    if rows:
+        report_bad_puzzle(SudokuError('Incomplete puzzle', start), on_error)
+
+
+def report_bad_puzzle(error, on_error):
+    if on_error is not None:
+        on_error(error)
+    else:
+        print('Line ' + str(error.line) + ': ' + error.message, file=sys.stderr)
+
+
+class CandidateView(Mapping):
+    # Read-only dict-like view of a list of per-cell masks, keyed by (i, j)
+    # coordinates and yielding sorted digit lists, so that code written
+    # against marked_dict / canceled_dict keeps working. Only the cells
+    # for which include(cell) holds are keys.
+    def __init__(self, masks, include, layout=LAYOUT):
+        self.masks = masks
+        self.include = include
+        self.layout = layout
+
+    def __getitem__(self, coordinate):
+        size = self.layout.size
+        try:
+            i, j = coordinate
+            cell = i * size + j
+        except (TypeError, ValueError):
+            raise KeyError(coordinate)
+        if not (0 <= i < size and 0 <= j < size and self.include(cell)):
+            raise KeyError(coordinate)
+        return digits_of(self.masks[cell])
+
+    def __iter__(self):
+        return (self.layout.coordinates[c] for c in self.layout.cells if self.include(c))
+
+    def __len__(self):
+        return sum(1 for c in self.layout.cells if self.include(c))
 
 
 class Sudoku:
     def __init__(self, filename):
-        path = os.getcwd() + '/' + filename
-        self.name = filename.replace('.txt', '')
+        path = os.path.join(os.getcwd(), filename)
         with open(path) as file:
-            self.grid = [line.strip() for line in file if line.strip() != '']
+            self.setup(file, filename.replace('.txt', ''))
+
+    @classmethod
+    def from_string(cls, text, name='sudoku'):
+        # Same layout as the input files, or all the cells on one line, with
+        # 0 or . for the empty cells
+        sudoku = cls.__new__(cls)
+        sudoku.setup(text.splitlines(), name)
+        return sudoku
+
+    @classmethod
+    def from_rows(cls, rows, name='sudoku'):
+        # rows are strings as in the input files or sequences of ints or of
+        # cells as strings, one per row of the board
+        lines = [row if isinstance(row, str) else ' '.join(map(str, row)) for row in rows]
+        sudoku = cls.__new__(cls)
+        sudoku.setup(lines, name)
+        return sudoku
+
+    def setup(self, lines, name):
+        self.name = name
+        self.grid = [cells for cells in map(split_cells, lines) if cells]
+        if len(self.grid) == 1:
+            size = math.isqrt(len(self.grid[0]))
+            if size in ROW_SIZES and size * size == len(self.grid[0]):
+                self.grid = [self.grid[0][i:i + size] for i in range(0, size * size, size)]
         self.check_input()
         self.check_length()
 
-        self.marked_dict = dict()
-        self.canceled_dict = dict()
-        for box in self.get_all_box_coordinates():
-            for coordinate in box:
-                if self.grid[coordinate[0]][coordinate[1]] == 0:
-                    self.marked_dict[coordinate] = []
+        # Flat copy of grid, candidates and canceled digits of each cell as
+        # masks of a bit per digit, all indexed by cell, and the digits
+        # present in each row, column and box.
+        layout = self.layout
+        n = layout.size
+        self.candidates = [0] * (n * n)
+        self.canceled = [0] * (n * n)
+        self.values = [self.grid[i][j] for i, j in layout.coordinates]
+        self.row_used = [0] * n
+        self.column_used = [0] * n
+        self.box_used = [0] * n
+        # For each digit, how many times it is on the grid and the rows and
+        # columns it is in, and the bitboard of nonempty cells
+        self.frequency = [0] * (n + 1)
+        self.digit_rows = [0] * (n + 1)
+        self.digit_columns = [0] * (n + 1)
+        self.occupied = 0
+        for c in layout.cells:
+            if self.values[c] != 0:
+                self.mark_used(c, self.values[c])
+        # Units (indices into layout.units) whose candidates changed since
+        # they were last searched for preemptive sets
+        self.dirty_units = deque()
+        self.is_dirty = [False] * len(layout.units)
+        # Journal of every change since the puzzle was read, as packed
+        # records (see unpack_record): the deletion of a digit from the
+        # candidates of a cell, the insertion of a digit in a cell, or the
+        # marking of the candidates. canceled is the union of the deletions,
+        # undo() rolls the state back to any earlier length of the journal,
+        # and replay() rebuilds the state at any step from the givens.
+        self.givens = self.values.copy()
+        self.journal = array('I')
+        self.starting = False
+        self.marked_dict = CandidateView(self.candidates, self.is_empty, layout)
+        self.canceled_dict = CandidateView(self.canceled, self.canceled.__getitem__, layout)
         self.highest_frequency = []
         self.update_frequency()
+        # Counters and timings are only gathered when a Stats object (see
+        # sudoku_stats) is set here
+        self.stats = None
+        # Budget of the running entry point, if it was given one
+        self.budget = None
+
+    def mark_used(self, cell, num):
+        bit = digit_bit(num)
+        i = self.layout.row_of[cell]
+        j = self.layout.column_of[cell]
+        self.row_used[i] |= bit
+        self.column_used[j] |= bit
+        self.box_used[self.layout.box_of[cell]] |= bit
+        self.frequency[num] += 1
+        self.digit_rows[num] |= 1 << i
+        self.digit_columns[num] |= 1 << j
+        self.occupied |= 1 << cell
+
+    def unmark_used(self, cell, num):
+        bit = digit_bit(num)
+        i = self.layout.row_of[cell]
+        j = self.layout.column_of[cell]
+        self.row_used[i] &= ~bit
+        self.column_used[j] &= ~bit
+        self.box_used[self.layout.box_of[cell]] &= ~bit
+        self.frequency[num] -= 1
+        self.digit_rows[num] &= ~(1 << i)
+        self.digit_columns[num] &= ~(1 << j)
+        self.occupied &= ~(1 << cell)
+
+    def is_empty(self, cell):
+        return self.values[cell] == 0
+
+    def free_digits(self, cell):
+        layout = self.layout
+        return layout.all_digits & ~(self.row_used[layout.row_of[cell]] |
+                                     self.column_used[layout.column_of[cell]] |
+                                     self.box_used[layout.box_of[cell]])
+
+    def set_value(self, cell, num):
+        self.grid[self.layout.row_of[cell]][self.layout.column_of[cell]] = num
+        self.values[cell] = num
+        self.mark_used(cell, num)
+
+    def place(self, cell, num, technique=BY_SEARCH):
+        # Insert num in cell and delete it from the candidates of its peers
+        self.starting = True
+        if self.candidates[cell]:
+            self.eliminate(cell, self.candidates[cell], technique)
+        self.set_value(cell, num)
+        self.record(cell << 12 | technique << 8 | PLACED | num)
+        self.touch(cell)
+        self.delete_singleton(self.layout.peers[cell], num, technique)
+
+    def eliminate(self, cell, mask, technique=BY_SEARCH):
+        self.candidates[cell] ^= mask
+        self.canceled[cell] |= mask
+        for num in digits_of(mask):
+            self.record(cell << 12 | technique << 8 | num)
+        self.touch(cell)
+
+    def record(self, record):
+        if self.starting:
+            record |= STEP_START
+            self.starting = False
+        self.journal.append(record)
+
+    def undo(self, mark):
+        # Marking records are dropped without unmarking the candidates
+        journal = self.journal
+        while len(journal) > mark:
+            record = journal.pop()
+            cell = record >> 12
+            num = record & 63
+            if record & PLACED:
+                self.grid[self.layout.row_of[cell]][self.layout.column_of[cell]] = 0
+                self.values[cell] = 0
+                self.unmark_used(cell, num)
+            elif num:
+                self.candidates[cell] |= digit_bit(num)
+                self.canceled[cell] &= ~digit_bit(num)
+
+    def touch(self, cell):
+        for u in self.layout.unit_ids_of[cell]:
+            if not self.is_dirty[u]:
+                self.is_dirty[u] = True
+                self.dirty_units.append(u)
 
     def update_frequency(self):
-        temp = []
-        for row in self.grid:
-            temp.extend(row)
-        self.highest_frequency = Counter(temp).most_common(10)
-        if self.highest_frequency[0][0] == 0:
-            self.highest_frequency.pop(0)
+        self.highest_frequency = sorted(((num, self.frequency[num]) for num in range(1, self.layout.size + 1)),
+                                        key=lambda f: -f[1])
 
     def check_input(self):
+        # Cells are digits, letters from A for 10 on, or numbers; none may be
+        # above the number of rows
         for i in range(len(self.grid)):
-            line = self.grid[i].replace(' ', '')
-            try:
-                line = list(map(int, line))
-                for e in line:
-                    if e not in [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]:
-                        raise SudokuError('Incorrect input')
-            except ValueError:
-                raise SudokuError('Incorrect input')
+            line = []
+            for cell in self.grid[i]:
+                if cell.upper() in SYMBOL_VALUES:
+                    e = SYMBOL_VALUES[cell.upper()]
+                elif cell.isdecimal():
+                    e = int(cell)
+                else:
+                    raise SudokuError('Incorrect input')
+                if e > len(self.grid):
+                    raise SudokuError('Incorrect input')
+                line.append(e)
             self.grid[i] = line
 
     def check_length(self):
-        if len(self.grid) != 9:
+        # The board is square, with as many rows as a box has cells
+        box_size = math.isqrt(len(self.grid))
+        if box_size not in BOX_SIZES or box_size * box_size != len(self.grid):
             raise SudokuError('Incorrect input')
         for line in self.grid:
-            if len(line) != 9:
+            if len(line) != len(self.grid):
                 raise SudokuError('Incorrect input')
+        self.layout = layout_for(box_size)
 
     def preassess(self):
         if not self.check_row() or not self.check_column() or not self.check_grid():
@@ -61,491 +581,494 @@ class Sudoku:
         print('There might be a solution.')
 
     def check_row(self):
+        n = self.layout.size
         for line in self.grid:
-            for num in range(1, 10):
+            for num in range(1, n + 1):
                 if line.count(num) > 1:
                     return False
         return True
 
     def check_column(self):
-        for i in range(9):
+        n = self.layout.size
+        for i in range(n):
             line = []
-            for j in range(9):
+            for j in range(n):
                 line.append(self.grid[j][i])
-                for num in range(1, 10):
-                    if line.count(num) > 1:
-                        return False
+            for num in range(1, n + 1):
+                if line.count(num) > 1:
+                    return False
         return True
 
     def check_grid(self):
-        for i in range(0, 7, 3):
-            for j in range(0, 7, 3):
+        n = self.layout.size
+        b = self.layout.box_size
+        for i in range(0, n, b):
+            for j in range(0, n, b):
                 mini = self.get_mini_grid(i, j)
-                for num in range(1, 10):
+                for num in range(1, n + 1):
                     if mini.count(num) > 1:
                         return False
         return True
 
     def get_mini_grid(self, start_i, start_j):
+        b = self.layout.box_size
         mini_grid = []
-        for i in range(start_i, start_i + 3):
-            mini_grid.extend(self.grid[i][start_j: start_j+3])
+        for i in range(start_i, start_i + b):
+            mini_grid.extend(self.grid[i][start_j: start_j+b])
         return mini_grid
 
-    def bare_tex_output(self):
-        self.write_latex_head(self.name + '_bare.tex')
-        self.write_bare_body(self.name + '_bare.tex')
-        self.write_latex_ass(self.name + '_bare.tex')
-
-    def write_latex_head(self, name):
-        file = open(name, 'w')
-        head = ['\documentclass[10pt]{article}',
-                '\\usepackage[left=0pt,right=0pt]{geometry}',
-                '\\usepackage{tikz}',
-                '\\usetikzlibrary{positioning}',
-                '\\usepackage{cancel}',
-                '\pagestyle{empty}\n',
-                '\\newcommand{\\N}[5]{\\tikz{\\node[label=above left:{\\tiny #1},',
-                '                               label=above right:{\\tiny #2},',
-                '                               label=below left:{\\tiny #3},',
-                '                               label=below right:{\\tiny #4}]{#5};}}\n',
-                '\\begin{document}\n',
-                '\\tikzset{every node/.style={minimum size=.5cm}}\n',
-                '\\begin{center}',
-                '\\begin{tabular}{||@{}c@{}|@{}c@{}|@{}c@{}||@{}c@{}|@{}c@{}|@{}c@{}||@{}c@{}|@{}c@{}|@{}c@{}||}\hline\hline\n']
-        file.write('\n'.join(head))
-        file.close()
-
-    def write_latex_ass(self, name):
-        file = open(name, 'a')
-        ass = ['\end{tabular}', '\end{center}\n', '\end{document}\n']
-        file.write('\n'.join(ass))
-        file.close()
-
-    def write_bare_body(self, name):
-        file = open(name, 'a')
-        for i in range(9):
-            line = '% Line ' + str(i+1) + '\n'
-            body = []
-            for j in range(9):
-                if self.grid[i][j] != 0:
-                    t = '\\N{}{}{}{}{' + str(self.grid[i][j]) + '}'
-                else:
-                    t = '\\N{}{}{}{}{}'
-                if j != 8:
-                    t += ' & '
-                else:
-                    if i % 3 == 2:
-                        t += ' \\\\ \hline\hline'
-                        if (i, j) != (8, 8):
-                            t += '\n'
-                    else:
-                        t += ' \\\\ \hline\n'
-                if j % 3 == 2:
-                    t = t.rstrip(' ') + '\n'
-                body.append(t)
-            file.write(line + ''.join(body))
-        file.close()
-
-    def write_marked_body(self, name):
-        file = open(name, 'a')
-        for i in range(9):
-            line = '% Line ' + str(i + 1) + '\n'
-            body = []
-            for j in range(9):
-                if self.grid[i][j] != 0:
-                    t = '\\N{}{}{}{}{' + str(self.grid[i][j]) + '}'
-                else:
-                    # If the cell is marked
-                    marked = self.marked_dict[(i, j)]
-                    t1 = []
-                    t2 = []
-                    t3 = []
-                    t4 = []
-                    for m in marked:
-                        if m == 1 or m == 2:
-                            t1.append(str(m))
-                        a = '{' + ' '.join(t1) + '}'
-                        if m == 3 or m == 4:
-                            t2.append(str(m))
-                        b = '{' + ' '.join(t2) + '}'
-                        if m == 5 or m == 6:
-                            t3.append(str(m))
-                        c = '{' + ' '.join(t3) + '}'
-                        if m == 7 or m == 8 or m ==9:
-                            t4.append(str(m))
-                        d = '{' + ' '.join(t4) + '}'
-                    t = '\\N' + a + b + c + d + '{}'
-                if j != 8:
-                    t += ' & '
-                else:
-                    if i % 3 == 2:
-                        t += ' \\\\ \hline\hline'
-                        if (i, j) != (8, 8):
-                            t += '\n'
-                    else:
-                        t += ' \\\\ \hline\n'
-                if j % 3 == 2:
-                    t = t.rstrip(' ') + '\n'
-                body.append(t)
-            file.write(line + ''.join(body))
-        file.close()
-
-    def forced_tex_output(self):
-        self.force()
-        self.write_latex_head(self.name + '_forced.tex')
-        self.write_bare_body(self.name + '_forced.tex')
-        self.write_latex_ass(self.name + '_forced.tex')
+    def bare_tex_output(self, cache=None):
+        self.tex_output('bare', cache)
 
-    def marked_tex_output(self):
-        self.force()
-        self.get_marked()
-        self.write_latex_head(self.name + '_marked.tex')
-        self.write_marked_body(self.name + '_marked.tex')
-        self.write_latex_ass(self.name + '_marked.tex')
-
-    def worked_tex_output(self):
-        self.worked()
-        self.write_latex_head(self.name + '_worked.tex')
-        self.write_worked_body(self.name + '_worked.tex')
-        self.write_latex_ass(self.name + '_worked.tex')
-
-    def write_worked_body(self, name):
-        file = open(name, 'a')
-        for i in range(9):
-            line = '% Line ' + str(i + 1) + '\n'
-            body = []
-            for j in range(9):
-                try:
-                    marked = self.marked_dict[(i, j)]
-                except KeyError:
-                    marked = []
-                try:
-                    canceled = [-1*x for x in self.canceled_dict[(i, j)]]
-                except KeyError:
-                    canceled = []
-                marked.extend(reversed(sorted(canceled)))
-                marked = sorted(marked, key=abs)
-                t1 = []
-                t2 = []
-                t3 = []
-                t4 = []
-                a, b, c, d = '{}', '{}', '{}', '{}'
-                for m in marked:
-                    if abs(m) == 1 or abs(m) == 2:
-                        if m < 0:
-                            # o = '\cancel{'+str(abs(m))+'}'
-                            t1.append('\cancel{'+str(abs(m))+'}')
-                        else:
-                            t1.append(str(m))
-                    a = '{' + ' '.join(t1) + '}'
-                    if abs(m) == 3 or abs(m) == 4:
-                        if m < 0:
-                            # o = '\cancel{'+str(abs(m))+'}'
-                            t2.append('\cancel{'+str(abs(m))+'}')
-                        else:
-                            t2.append(str(m))
-                    b = '{' + ' '.join(t2) + '}'
-                    if abs(m) == 5 or abs(m) == 6:
-                        if m < 0:
-                            # o = '\cancel{'+str(abs(m))+'}'
-                            t3.append('\cancel{'+str(abs(m))+'}')
-                        else:
-                            t3.append(str(m))
-                    c = '{' + ' '.join(t3) + '}'
-                    if abs(m) == 7 or abs(m) == 8 or abs(m) == 9:
-                        if m < 0:
-                            # o = '\cancel{'+str(abs(m))+'}'
-                            t4.append('\cancel{'+str(abs(m))+'}')
-                        else:
-                            t4.append(str(m))
-                    d = '{' + ' '.join(t4) + '}'
-                if self.grid[i][j] != 0:
-                    e = '{' + str(self.grid[i][j]) + '}'
-                else:
-                    e = '{}'
-                t = '\\N' + a + b + c + d + e
-                if j != 8:
-                    t += ' & '
+    def forced_tex_output(self, cache=None):
+        self.tex_output('forced', cache)
+
+    def marked_tex_output(self, cache=None):
+        self.tex_output('marked', cache)
+
+    def worked_tex_output(self, cache=None):
+        self.tex_output('worked', cache)
+
+    def tex_output(self, mode, cache=None):
+        # With a RenderCache (see sudoku_cache), a document already rendered
+        # for the same grid and mode is reused without doing the work again.
+        if cache is not None:
+            cache.tex_output(self, mode, self.name + '_' + mode + '.tex')
+            return
+        self.prepare(mode)
+        with open(self.name + '_' + mode + '.tex', 'w') as file:
+            self.write_tex(file, mode)
+
+    def fingerprint(self):
+        # The grid as a string of a symbol per cell, 81 digits on a 9 x 9 board
+        return ''.join(SYMBOLS[num] for num in self.values)
+
+    @timed
+    @budgeted
+    def prepare(self, mode):
+        if mode == 'forced':
+            self.force()
+        elif mode == 'marked':
+            self.force()
+            self.get_marked()
+        elif mode == 'worked':
+            self.worked()
+
+    @timed
+    def write_tex(self, out, mode):
+        # Writes the document of the current state to the file-like out
+        parts = [LATEX_PREAMBLE, self.layout.tex_head]
+        self.tex_body(parts, mode)
+        parts.append(self.layout.tex_tail)
+        parts.append(LATEX_END)
+        out.write(''.join(parts))
+
+    def tex_body(self, parts, mode):
+        # Appends the rows of the tabular to parts
+        body = TEX_BODIES[mode]
+        layout = self.layout
+        n = layout.size
+        for i in range(n):
+            parts.append(layout.tex_lines[i])
+            for c in layout.rows[i]:
+                num = self.values[c]
+                if body == 'bare' or body == 'marked' and num:
+                    parts.append(tex_cell(0, 0, num, n))
+                elif body == 'marked':
+                    parts.append(tex_cell(self.candidates[c], 0, 0, n))
                 else:
-                    if i % 3 == 2:
-                        t += ' \\\\ \hline\hline'
-                        if (i, j) != (8, 8):
-                            t += '\n'
-                    else:
-                        t += ' \\\\ \hline\n'
-                if j % 3 == 2:
-                    t = t.rstrip(' ') + '\n'
-                body.append(t)
-            file.write(line + ''.join(body))
-        file.close()
+                    parts.append(tex_cell(0 if num else self.candidates[c], self.canceled[c], num, n))
+                parts.append(layout.tex_separators[c])
+
+    def step_starts(self):
+        # Index in the journal of the first record of each step
+        return [k for k, record in enumerate(self.journal) if record & STEP_START]
+
+    def replica(self):
+        # A new Sudoku holding the givens, on which the journal is replayed
+        n = self.layout.size
+        return Sudoku.from_rows([self.givens[i:i + n] for i in range(0, n * n, n)], self.name)
+
+    def apply(self, record):
+        # Redoes a record of the journal of another Sudoku with the same
+        # givens, and appends it to this journal
+        cell, num, technique, placed, _ = unpack_record(record)
+        if placed:
+            self.set_value(cell, num)
+            self.candidates[cell] = 0
+        elif technique == BY_MARKING:
+            self.mark_candidates()
+        else:
+            self.candidates[cell] &= ~digit_bit(num)
+            self.canceled[cell] |= digit_bit(num)
+        self.journal.append(record)
+
+    def walk(self):
+        # Yields the state after each step of the journal, step 0 being the
+        # givens, as one replica brought forward in place: copy what is
+        # needed from it before going on
+        state = self.replica()
+        yield state
+        records = self.journal
+        for k in range(len(records)):
+            state.apply(records[k])
+            if k + 1 == len(records) or records[k + 1] & STEP_START:
+                yield state
+
+    def replay(self, step=None):
+        # The state after step steps of the journal (all of them by
+        # default), rebuilt from the givens without redoing the work
+        starts = self.step_starts()
+        if step is not None and not 0 <= step <= len(starts):
+            raise SudokuError('No step ' + str(step) + ' in ' + str(len(starts)) + ' steps')
+        end = len(self.journal) if step is None or step == len(starts) else starts[step]
+        state = self.replica()
+        for k in range(end):
+            state.apply(self.journal[k])
+        return state
+
+    def describe_step(self, step):
+        # (technique name, placements as (cell, digit), eliminations as
+        # (cell, digit)) of step step, counted from 1
+        starts = self.step_starts()
+        if not 1 <= step <= len(starts):
+            raise SudokuError('No step ' + str(step) + ' in ' + str(len(starts)) + ' steps')
+        end = starts[step] if step < len(starts) else len(self.journal)
+        placements = []
+        eliminations = []
+        for k in range(starts[step - 1], end):
+            cell, num, _, placed, _ = unpack_record(self.journal[k])
+            if placed:
+                placements.append((cell, num))
+            elif num:
+                eliminations.append((cell, num))
+        return TECHNIQUES[unpack_record(self.journal[starts[step - 1]])[2]], placements, eliminations
+
+    def write_step_tex(self, out, step, mode='worked'):
+        # Writes the document of the state after step steps to out
+        self.replay(step).write_tex(out, mode)
+
+    def step_tex_output(self, mode='worked'):
+        # Writes the document of the state after each step of the journal
+        # to name_step_N.tex, without redoing the work
+        for step, state in enumerate(self.walk()):
+            with open(self.name + '_step_' + str(step) + '.tex', 'w') as file:
+                state.write_tex(file, mode)
 
     def find_preemptive_pair_in_row(self, n):
-        marked_dic = dict()
-        temp = []
-        signal = True
-        for i in range(9):
-            try:
-                marked_dic[(n, i)] = sorted(set(self.marked_dict[(n, i)]))
-                temp.extend(sorted(self.marked_dict[(n, i)]))
-            except KeyError:
-                pass
-        marked_comb = []
-        empty_cell_num = len(set(temp))
-        min_len = min([len(l) for l in marked_dic.values()])
-        if min_len < 2:
-            min_len = 2
-        for l in range(min_len, len(marked_dic.values()) + 1):
-            marked_comb.extend(set(combinations(set(temp), l)))
-        for comb in marked_comb:
-            pre_set = dict()
-            for c, e in marked_dic.items():
-                if set(e) <= set(comb) and len(e) <= len(comb) and e != []:
-                    pre_set[c] = e
-            if len(pre_set) == len(comb) and len(pre_set) != empty_cell_num:
-                # found one pre-emptive set
-                delete_dict = marked_dic.copy()
-                for k in pre_set.keys():
-                    delete_dict.pop(k)
-                # print('### row ###')
-                # print(f'Preemptive set is {comb} : {pre_set}, need to delete {delete_dict}')
-                signal = self.delete_from_marked(comb, delete_dict, 'row')
-                # return signal
-        return signal
+        return self.find_preemptive_set(self.layout.rows[n], 'row')
 
     def find_preemptive_pair_in_column(self, n):
-        marked_dic = dict()
-        temp = []
-        signal = True
-        for i in range(9):
-            try:
-                marked_dic[(i, n)] = sorted(set(self.marked_dict[(i, n)]))
-                temp.extend(sorted(self.marked_dict[(i, n)]))
-            except KeyError:
-                pass
-        marked_comb = []
-        empty_cell_num = len(set(temp))
-        min_len = min([len(l) for l in marked_dic.values()])
-        if min_len < 2:
-            min_len = 2
-        for l in range(min_len, len(marked_dic.values()) + 1):
-            marked_comb.extend(set(combinations(set(temp), l)))
-        for comb in marked_comb:
-            pre_set = dict()
-            for c, e in marked_dic.items():
-                if set(e) <= set(comb) and len(e) <= len(comb) and e != []:
-                    pre_set[c] = e
-            if len(pre_set) == len(comb) and len(pre_set) != empty_cell_num:
-                # found one pre-emptive set
-                delete_dict = marked_dic.copy()
-                for k in pre_set.keys():
-                    delete_dict.pop(k)
-                # print('### column ###')
-                # print(f'Preemptive set is {comb} : {pre_set}, need to delete {delete_dict}')
-                signal = self.delete_from_marked(comb, delete_dict, 'column')
-                # return signal
-        return signal
+        return self.find_preemptive_set(self.layout.columns[n], 'column')
 
     def find_preemptive_pair_in_box(self, i, j):
-        temp = []
-        marked_dic = dict()
-        signal = True
-        box_c = self.get_box_coordinates(i, j)
-        for c in box_c:
-            try:
-                temp.extend(sorted(self.marked_dict[(c[0], c[1])]))
-                marked_dic[(c[0], c[1])] = sorted(self.marked_dict[(c[0], c[1])])
-            except KeyError:
-                pass
-        empty_cell_num = len(set(temp))
-        marked_comb = []
-        min_len = min([len(l) for l in marked_dic.values()])
-        if min_len < 2:
-            min_len = 2
-        for l in range(min_len, len(marked_dic.values())+1):
-            marked_comb.extend(set(combinations(set(temp), l)))
-        for comb in marked_comb:
-            pre_set = dict()
-            for c, e in marked_dic.items():
-                if set(e) <= set(comb) and len(e) <= len(comb) and e != []:
-                    pre_set[c] = e
-            if len(pre_set) == len(comb) and len(pre_set) != empty_cell_num:
-                # Found pre-emptive set
-                delete_dict = marked_dic.copy()
-                for k in pre_set.keys():
-                    delete_dict.pop(k)
-                # print('### box ###')
-                # print(f'Preemptive set is {comb} : {pre_set}, need to delete {delete_dict}')
-                signal = self.delete_from_marked(comb, delete_dict, 'box')
-                # return signal
-        return signal
+        layout = self.layout
+        return self.find_preemptive_set(layout.boxes[layout.box_of[i * layout.size + j]], 'box')
+
+    @timed
+    def find_preemptive_set(self, unit, type):
+        # A preemptive set is k cells of the unit whose candidates are only k
+        # digits (naked), which may then be deleted from the other cells. Its
+        # complement in the unit is k' digits that only fit in k' cells
+        # (hidden), whose other candidates may be deleted, so both kinds are
+        # only searched up to half the empty cells, and up to MAX_SET_SIZE.
+        # Stops at the first set that changes anything, the unit being
+        # queued again by the change.
+        all_digits = self.layout.all_digits
+        cells = [c for c in unit if self.values[c] == 0 and self.candidates[c]]
+        n = len(cells)
+        for k in range(2, min(n // 2, MAX_SET_SIZE) + 1):
+            for chosen, comb in find_subsets([self.candidates[c] for c in cells], k, self.stats):
+                others = [c for p, c in enumerate(cells) if not chosen >> p & 1]
+                if self.stats is not None:
+                    self.count_set('naked', comb, others, type)
+                if not self.delete_from_marked(comb, others, type):
+                    return False
+        positions = [0] * self.layout.size
+        for p, c in enumerate(cells):
+            for num in digits_of(self.candidates[c]):
+                positions[num - 1] |= 1 << p
+        for k in range(1, min((n - 1) // 2, MAX_SET_SIZE) + 1):
+            for chosen, where in find_subsets(positions, k, self.stats):
+                inside = [c for p, c in enumerate(cells) if where >> p & 1]
+                if self.stats is not None:
+                    self.count_set('hidden', all_digits & ~chosen, inside, type)
+                if not self.delete_from_marked(all_digits & ~chosen, inside, type, BY_HIDDEN_SET):
+                    return False
+        return True
+
+    def count_set(self, kind, mask, cells, type):
+        # Records a preemptive set and the candidates it is about to delete
+        deleted = sum((self.candidates[c] & mask).bit_count() for c in cells)
+        self.stats.count(f'preemptive.{kind}.{type}')
+        if deleted:
+            self.stats.count(f'preemptive.{kind}.{type}.useful')
+            self.stats.count(f'eliminations.{kind}_set', deleted)
 
     def get_all_box_coordinates(self):
-        box_c = []
-        for i in range(0, 7, 3):
-            for j in range(0, 7, 3):
-                temp = []
-                for a in range(i, i+3):
-                    for b in range(j, j+3):
-                        temp.append((a, b))
-                box_c.append(temp)
-        return box_c
+        return [list(box) for box in self.layout.box_coordinates]
 
     def get_box_coordinates(self, i, j):
-        all_coordinates = self.get_all_box_coordinates()
-        if i < 3 and j < 3:
-            return all_coordinates[0]
-        elif i < 3 and j < 6:
-            return all_coordinates[1]
-        elif i < 3 and j < 9:
-            return all_coordinates[2]
-        elif i < 6 and j < 3:
-            return all_coordinates[3]
-        elif i < 6 and j < 6:
-            return all_coordinates[4]
-        elif i < 6 and j < 9:
-            return all_coordinates[5]
-        elif i < 9 and j < 3:
-            return all_coordinates[6]
-        elif i < 9 and j < 6:
-            return all_coordinates[7]
-        elif i < 9 and j < 9:
-            return all_coordinates[8]
+        layout = self.layout
+        return layout.box_coordinates[layout.box_of[i * layout.size + j]]
 
     def get_collumn(self, n):
-        return [self.grid[i][n] for i in range(9)]
+        return [self.grid[i][n] for i in range(self.layout.size)]
 
+    @timed
     def get_marked(self):
-        boxes = self.get_all_box_coordinates()
-        for box in boxes:
-            b = self.get_mini_grid(box[0][0], box[0][1])
-            for coordinate in box:
-                column = set(self.get_collumn(coordinate[1]))
-                row = set(self.grid[coordinate[0]])
-                b = set(b)
-                try:
-                    column.remove(0), row.remove(0), b.remove(0)
-                except KeyError:
-                    pass
-                for num in range(1, 10):
-                    try:
-                        if num not in column and num not in row and num not in b and num not in self.marked_dict[coordinate]:
-                            try:
-                                self.marked_dict[coordinate].append(num)
-                            except KeyError:
-                                break
-                                pass
-                    except KeyError:
-                        pass
+        self.starting = True
+        self.record(BY_MARKING << 8)
+        self.mark_candidates()
+
+    def mark_candidates(self):
+        for c in self.layout.cells:
+            if self.values[c] == 0:
+                self.candidates[c] |= self.free_digits(c) & ~self.canceled[c]
 
+    @timed
+    @budgeted
     def force(self):
         no_change = False
         while not no_change:
             no_change = True
+            if self.budget is not None:
+                self.budget.step()
+            if self.stats is not None:
+                self.stats.count('force.passes')
+            self.update_frequency()
             for f in self.highest_frequency:
-                for i in range(0, 7, 3):
-                    for j in range(0, 7, 3):
-                        box = self.get_mini_grid(i, j)
-                        box_c = self.get_box_coordinates(i, j)
-                        potential_force = []
-                        if f[0] not in box:
-                            # Can insert
-                            for c in box_c:
-                                # check each coordinate that is empty in box
-                                if self.grid[c[0]][c[1]] == 0:
-                                    # Can I insert f[0] into grid[c[0]][c[1]] ?
-                                    if self.can_insert_row(c[0], f[0]) and self.can_insert_column(c[1], f[0]):
-                                        potential_force.append((c, f[0]))
-                            if len(potential_force) == 1:
-                                self.grid[potential_force[0][0][0]][potential_force[0][0][1]] = potential_force[0][1]
-                                self.update_frequency()
-                                self.marked_dict.pop((potential_force[0][0][0], potential_force[0][0][1]))
-                                no_change = False
+                bit = digit_bit(f[0])
+                blocked = self.blocked_cells(f[0])
+                for b in range(self.layout.size):
+                    if not self.box_used[b] & bit:
+                        # Can insert f[0] only in the empty cells of the box
+                        # out of the rows and columns that already have it
+                        potential_force = self.layout.box_bits[b] & ~blocked
+                        if potential_force and not potential_force & (potential_force - 1):
+                            self.place(potential_force.bit_length() - 1, f[0], BY_FORCE)
+                            if self.stats is not None:
+                                self.stats.count('placements.forced')
+                            blocked = self.blocked_cells(f[0])
+                            no_change = False
+
+    def blocked_cells(self, num):
+        blocked = self.occupied
+        for i in digits_of(self.digit_rows[num]):
+            blocked |= self.layout.row_bits[i - 1]
+        for j in digits_of(self.digit_columns[num]):
+            blocked |= self.layout.column_bits[j - 1]
+        return blocked
 
     def can_insert_row(self, n, f):
-        row = self.grid[n].copy()
-        row.append(f)
-        if row.count(f) > 1:
-            return False
-        return True
+        return not self.row_used[n] & digit_bit(f)
 
     def can_insert_column(self, n, f):
-        column = self.get_collumn(n)
-        column.append(f)
-        if column.count(f) > 1:
-                return False
-        return True
+        return not self.column_used[n] & digit_bit(f)
+
+    def delete_from_marked(self, comb, delete_list, type, technique=BY_NAKED_SET):
+        changes = len(self.journal)
+        self.starting = True
+        for c in delete_list:
+            removed = self.candidates[c] & comb
+            if removed:
+                self.eliminate(c, removed, technique)
+        self.starting = False
+        self.place_singletons()
+        return len(self.journal) == changes
 
-    def delete_from_marked(self, comb, delete_dic, type):
-        copy_marked = deepcopy(self.marked_dict)
-        for grid_c, marked in delete_dic.items():
-            for c in comb:
-                if c in self.marked_dict[grid_c]:
-                    self.marked_dict[grid_c].remove(c)
-                    try:
-                        self.canceled_dict[grid_c].append(c)
-                    except KeyError:
-                        self.canceled_dict[grid_c] = [c]
+    def place_singletons(self):
+        placed = False
         not_found = False
         while not not_found:
             c, not_found = self.search_for_singleton()
             if not_found:
                 break
-            self.grid[c[0]][c[1]] = self.marked_dict[c][0]
-            try:
-                self.canceled_dict[c].append(self.marked_dict[c].pop())
-            except KeyError:
-                self.canceled_dict[c] = [self.marked_dict[c].pop()]
-            # delete the rest of the nums from the inserted shit
-            type_c = []
-            type_c.extend([(c[0], i) for i in range(9)])
-            type_c.extend([(i, c[1]) for i in range(9)])
-            type_c.extend(self.get_box_coordinates(c[0], c[1]))
-            type_c = list(sorted(set(type_c)))
-            # print(f'Found singleton {self.grid[c[0]][c[1]]} on {c}')
-            self.delete_singleton(type_c, self.grid[c[0]][c[1]])
-        if copy_marked == self.marked_dict:
-            return True
-        else:
-            return False
+            self.place(c, self.candidates[c].bit_length(), BY_SINGLETON)
+            if self.stats is not None:
+                self.stats.count('placements.singleton')
+            placed = True
+        return placed
 
     def search_for_singleton(self):
-        for c, e in self.marked_dict.items():
-            if len(e) == 1:
+        for c in self.layout.box_order:
+            m = self.candidates[c]
+            if m and not m & (m - 1):
                 return c, False
         return None, True
 
-    def delete_singleton(self, coordinates, num):
-        for c in coordinates:
-            try:
-                self.marked_dict[c].remove(num)
-                try:
-                    self.canceled_dict[c].append(num)
-                except KeyError:
-                    self.canceled_dict[c] = [num]
-            except ValueError:
-                pass
-            except KeyError:
-                pass
+    def delete_singleton(self, cells, num, technique=BY_SEARCH):
+        bit = digit_bit(num)
+        for c in cells:
+            if self.candidates[c] & bit:
+                self.eliminate(c, bit, technique)
+                if self.stats is not None:
+                    self.stats.count('eliminations.placement')
 
+    @timed
+    @budgeted
     def worked(self):
         self.force()
         self.get_marked()
-        no_change = [False] * 3
-        search = True
-        while not all(no_change) and search:
-            for i in range(9):
-                no_change[0] = self.find_preemptive_pair_in_row(i)
-            for i in range(9):
-                no_change[1] = self.find_preemptive_pair_in_column(i)
-            for i in range(0, 7, 3):
-                for j in range(0, 7, 3):
-                    no_change[2] = self.find_preemptive_pair_in_box(i, j)
-            search = self.search_for_singleton()
+        # Every unit is searched once; after that a unit is searched again
+        # only when a placement or an elimination touched one of its cells.
+        units = self.layout.units
+        unit_types = self.layout.unit_types
+        for u in range(len(units)):
+            if not self.is_dirty[u]:
+                self.is_dirty[u] = True
+                self.dirty_units.append(u)
+        self.place_singletons()
+        while self.dirty_units:
+            u = self.dirty_units.popleft()
+            self.is_dirty[u] = False
+            if self.budget is not None:
+                self.budget.step()
+            if self.stats is not None:
+                self.stats.count('worked.units')
+            self.find_preemptive_set(units[u], unit_types[u])
+
+    @timed
+    @budgeted
+    def solve(self, max_nodes=100000, cache=None):
+        # Complete search: propagate naked and hidden singles, then branch on
+        # the empty cell with the fewest candidates. Returns the solved grid,
+        # or None if the puzzle has no solution; gives up with a
+        # BudgetExceeded for NODES after max_nodes branches. Only the grid is
+        # changed, the search being undone along the journal. With a
+        # SolutionCache (see sudoku_cache), a puzzle solved before, or
+        # equivalent to one with a canonical cache, is not searched again.
+        self.nodes = 0
+        self.max_nodes = max_nodes
+        if not self.check_row() or not self.check_column() or not self.check_grid():
+            return None
+        found = False
+        if cache is not None:
+            found, solution = cache.lookup(self.values)
+        if not found:
+            solution = self.search_solution()
+            if cache is not None:
+                cache.store(self.values, solution)
+        if solution is None:
+            return None
+        self.starting = True
+        for c in self.layout.cells:
+            if self.values[c] == 0:
+                self.set_value(c, solution[c])
+                self.candidates[c] = 0
+                self.record(c << 12 | BY_SEARCH << 8 | PLACED | solution[c])
+        return self.grid
+
+    def run(self, mode, budget=None, max_nodes=100000):
+        # Does the work of mode (forced, marked, worked or solve) within the
+        # budget and max_nodes and returns an Outcome: DONE, or why the work
+        # was cut short (NODES for max_nodes), and the state it left. The
+        # state is always consistent, a cut made during the search of
+        # solve() leaving the grid as it was before.
+        try:
+            if mode == 'solve':
+                self.solve(max_nodes, budget=budget)
+            else:
+                self.prepare(mode, budget=budget)
+            reason = DONE
+        except BudgetExceeded as e:
+            reason = e.reason
+        return Outcome(reason, [row[:] for row in self.grid], dict(self.marked_dict), dict(self.canceled_dict))
+
+    @timed
+    def search_solution(self):
+        saved = self.candidates.copy()
+        mark = len(self.journal)
+        for c in self.layout.cells:
+            if self.values[c] == 0:
+                self.candidates[c] = ((self.candidates[c] or self.layout.all_digits) &
+                                      self.free_digits(c) & ~self.canceled[c])
+        try:
+            return self.values.copy() if self.search() else None
+        finally:
+            self.undo(mark)
+            self.candidates[:] = saved
+            if self.stats is not None:
+                self.stats.count('search.nodes', self.nodes)
+
+    def search(self):
+        if not self.propagate_singles():
+            return False
+        best = None
+        best_count = self.layout.size + 1
+        for c in self.layout.cells:
+            if self.values[c] == 0:
+                count = self.candidates[c].bit_count()
+                if count < best_count:
+                    best, best_count = c, count
+                    if count == 2:
+                        break
+        if best is None:
+            return True
+        for num in digits_of(self.candidates[best]):
+            self.nodes += 1
+            if self.nodes > self.max_nodes:
+                raise BudgetExceeded(NODES)
+            if self.budget is not None:
+                self.budget.step()
+            mark = len(self.journal)
+            if self.assign(best, num) and self.search():
+                return True
+            self.undo(mark)
+        return False
+
+    def assign(self, cell, num):
+        self.place(cell, num)
+        for p in self.layout.peers[cell]:
+            if self.values[p] == 0 and not self.candidates[p]:
+                return False
+        return True
+
+    def propagate_singles(self):
+        values = self.values
+        allowed = self.candidates
+        cells = self.layout.cells
+        all_digits = self.layout.all_digits
+        changed = True
+        while changed:
+            changed = False
+            # Naked singles
+            for c in cells:
+                if values[c] == 0:
+                    m = allowed[c]
+                    if not m:
+                        return False
+                    if not m & (m - 1):
+                        if not self.assign(c, m.bit_length()):
+                            return False
+                        changed = True
+            # Hidden singles
+            for unit in self.layout.units:
+                once = twice = placed = 0
+                for c in unit:
+                    if values[c]:
+                        placed |= digit_bit(values[c])
+                    else:
+                        twice |= once & allowed[c]
+                        once |= allowed[c]
+                if once | placed != all_digits:
+                    return False
+                only = once & ~twice
+                if not only:
+                    continue
+                for c in unit:
+                    hidden = allowed[c] & only
+                    if values[c] == 0 and hidden:
+                        if hidden & (hidden - 1):
+                            return False
+                        if not self.assign(c, hidden.bit_length()):
+                            return False
+                        changed = True
+        return True
 
     def is_finished(self):
-        for i in range(9):
-            for j in range(9):
+        for i in range(self.layout.size):
+            for j in range(self.layout.size):
                 if self.grid[i][j] == 0:
                     return False
         return True
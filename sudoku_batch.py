@@ -0,0 +1,66 @@
+import os
+from collections import namedtuple
+from functools import partial
+from multiprocessing import Pool
+
+from sudoku import ROW_SIZES, Budget, Sudoku, SudokuError, split_cells
+
+
+SOLVED = 'solved'
+UNSOLVABLE = 'unsolvable'
+INVALID = 'invalid'
+# The search gave up after max_nodes branches or seconds of wall time
+UNFINISHED = 'unfinished'
+
+# Number of cells of each board size
+BOARD_CELLS = tuple(n * n for n in ROW_SIZES)
+
+BatchResult = namedtuple('BatchResult', ['index', 'status', 'grid', 'message'])
+
+
+def load_puzzle(puzzle):
+    # A puzzle is either the text of a grid (several lines, or all the cells
+    # on one line, with or without blanks between them) or the name of a
+    # file in the layout of sudoku_N.txt.
+    if '\n' in puzzle or len(split_cells(puzzle)) in BOARD_CELLS and not os.path.isfile(puzzle):
+        return Sudoku.from_string(puzzle)
+    return Sudoku(puzzle)
+
+
+def solve_one(item, max_nodes=100000, seconds=None):
+    index, puzzle = item
+    try:
+        sudoku = load_puzzle(puzzle)
+    except SudokuError as e:
+        return BatchResult(index, INVALID, None, e.message)
+    except OSError as e:
+        return BatchResult(index, INVALID, None, str(e))
+    return solve_sudoku(index, sudoku, max_nodes, seconds)
+
+
+def solve_sudoku(index, sudoku, max_nodes=100000, seconds=None):
+    try:
+        grid = sudoku.solve(max_nodes, budget=None if seconds is None else Budget(seconds))
+    except SudokuError as e:
+        return BatchResult(index, UNFINISHED, None, e.message)
+    if grid is None:
+        return BatchResult(index, UNSOLVABLE, None, 'There is no solution.')
+    return BatchResult(index, SOLVED, grid, '')
+
+
+def solve_batch(puzzles, processes=None, chunksize=64, ordered=True, max_nodes=100000, seconds=None):
+    # Solves every puzzle of the iterable on a pool of processes (one per
+    # core by default, none with processes=1) and yields a BatchResult for
+    # each, in input order or, with ordered=False, as soon as it is done.
+    # index is the position of the puzzle in the iterable. With seconds, no
+    # puzzle holds a worker longer than that.
+    work = partial(solve_one, max_nodes=max_nodes, seconds=seconds)
+    items = enumerate(puzzles)
+    if processes == 1:
+        yield from map(work, items)
+        return
+    with Pool(processes) as pool:
+        if ordered:
+            yield from pool.imap(work, items, chunksize)
+        else:
+            yield from pool.imap_unordered(work, items, chunksize)
@@ -0,0 +1,228 @@
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from sudoku import Sudoku, SudokuError, read_puzzles
+
+
+# Well-known hard puzzles, as a fixed part of every run
+HARD_PUZZLES = [
+    '1....7.9..3..2...8..96..5....53..9...1..8...26....4...3......1..4......7..7...3..',
+    '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......',
+    '.......1.4.........2...........5.4.7..8...3....1.9....3..4..2...5.1........8.6...',
+    '..............3.85..1.2.......5.7.....4...1...9.......5......73..2.1........4...9',
+]
+
+PHASES = ['parse', 'force', 'get_marked', 'worked', 'solve',
+          'render_bare', 'render_forced', 'render_marked', 'render_worked']
+
+
+def bundled_puzzles(directory=os.path.dirname(os.path.abspath(__file__))):
+    # The text of every sudoku_N.txt that can be read
+    puzzles = []
+    for path in sorted(glob.glob(os.path.join(directory, 'sudoku_*.txt'))):
+        with open(path) as file:
+            text = file.read()
+        try:
+            Sudoku.from_string(text)
+        except SudokuError:
+            continue
+        puzzles.append(text)
+    return puzzles
+
+
+def generated_puzzles(count, clues=26, seed=0):
+    # Random solvable puzzles: a few random digits, solved, then all but
+    # clues cells emptied. Not necessarily with a unique solution.
+    rng = random.Random(seed)
+    puzzles = []
+    while len(puzzles) < count:
+        sudoku = Sudoku.from_string('0' * 81)
+        for _ in range(11):
+            cell = rng.randrange(81)
+            num = rng.randint(1, 9)
+            if sudoku.values[cell] == 0 and sudoku.free_digits(cell) & 1 << (num - 1):
+                sudoku.set_value(cell, num)
+        if sudoku.solve() is None:
+            continue
+        values = sudoku.values.copy()
+        for cell in rng.sample(range(81), 81 - clues):
+            values[cell] = 0
+        puzzles.append(''.join(map(str, values)))
+    return puzzles
+
+
+def run_phases(text):
+    # Seconds spent in each phase for one puzzle, each on the state the
+    # corresponding output mode works from
+    times = {}
+    start = time.perf_counter()
+    sudoku = Sudoku.from_string(text)
+    times['parse'] = time.perf_counter() - start
+    buffer = io.StringIO()
+    start = time.perf_counter()
+    sudoku.write_tex(buffer, 'bare')
+    times['render_bare'] = time.perf_counter() - start
+    start = time.perf_counter()
+    sudoku.force()
+    times['force'] = time.perf_counter() - start
+    start = time.perf_counter()
+    sudoku.write_tex(buffer, 'forced')
+    times['render_forced'] = time.perf_counter() - start
+    start = time.perf_counter()
+    sudoku.get_marked()
+    times['get_marked'] = time.perf_counter() - start
+    start = time.perf_counter()
+    sudoku.write_tex(buffer, 'marked')
+    times['render_marked'] = time.perf_counter() - start
+    sudoku = Sudoku.from_string(text)
+    start = time.perf_counter()
+    sudoku.worked()
+    times['worked'] = time.perf_counter() - start
+    start = time.perf_counter()
+    sudoku.write_tex(buffer, 'worked')
+    times['render_worked'] = time.perf_counter() - start
+    sudoku = Sudoku.from_string(text)
+    start = time.perf_counter()
+    try:
+        sudoku.solve()
+    except SudokuError:
+        pass
+    times['solve'] = time.perf_counter() - start
+    return times
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def peak_memory(puzzles):
+    # Peak traced allocation of each phase, in KiB, over a separate pass
+    # since tracing slows everything down. As in run_phases, only the work
+    # of the phase is traced, not that of the state it starts from.
+    peaks = dict.fromkeys(PHASES, 0)
+    tracemalloc.start()
+    try:
+        for text in puzzles:
+            for phase in PHASES:
+                work = prepare_phase(phase, text)
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                work()
+                peaks[phase] = max(peaks[phase], tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    return {phase: round(peak / 1024, 1) for phase, peak in peaks.items()}
+
+
+def prepare_phase(phase, text):
+    # Brings a puzzle to the state phase starts from and returns a function
+    # doing the work of the phase alone
+    if phase == 'parse':
+        return lambda: Sudoku.from_string(text)
+    sudoku = Sudoku.from_string(text)
+    if phase.startswith('render_'):
+        mode = phase[len('render_'):]
+        sudoku.prepare(mode)
+        return lambda: sudoku.write_tex(io.StringIO(), mode)
+    if phase == 'get_marked':
+        sudoku.force()
+        return sudoku.get_marked
+    if phase == 'solve':
+        def solve():
+            try:
+                sudoku.solve()
+            except SudokuError:
+                pass
+        return solve
+    return getattr(sudoku, phase)
+
+
+def benchmark(corpora, repeat=1, memory=True):
+    # corpora maps a name to a list of puzzle texts
+    samples = {phase: [] for phase in PHASES}
+    for _ in range(repeat):
+        for puzzles in corpora.values():
+            for text in puzzles:
+                for phase, seconds in run_phases(text).items():
+                    samples[phase].append(seconds)
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'corpora': {name: len(puzzles) for name, puzzles in corpora.items()},
+        'phases': {},
+    }
+    for phase, seconds in samples.items():
+        total = sum(seconds)
+        report['phases'][phase] = {
+            'count': len(seconds),
+            'total_s': round(total, 6),
+            'per_second': round(len(seconds) / total, 1) if total else None,
+            'p50_ms': round(1000 * percentile(seconds, 0.5), 4),
+            'p99_ms': round(1000 * percentile(seconds, 0.99), 4),
+        }
+    if memory:
+        everything = [text for puzzles in corpora.values() for text in puzzles]
+        for phase, peak in peak_memory(everything).items():
+            report['phases'][phase]['peak_kib'] = peak
+    return report
+
+
+def compare(report, baseline, threshold):
+    # Phases whose median latency grew by more than threshold (a fraction)
+    # over the baseline report
+    regressions = []
+    for phase, stats in report['phases'].items():
+        old = baseline['phases'].get(phase)
+        if old and old['p50_ms'] and stats['p50_ms'] > old['p50_ms'] * (1 + threshold):
+            regressions.append((phase, old['p50_ms'], stats['p50_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each phase of the Sudoku engine.')
+    parser.add_argument('--generated', type=int, default=200, help='number of generated puzzles')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--corpus', action='append', default=[],
+                        help='file of extra puzzles (one line of 81 cells or 9 lines each)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory pass')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed growth of median latency over the baseline')
+    args = parser.parse_args(argv)
+
+    corpora = {'bundled': bundled_puzzles(), 'hard': HARD_PUZZLES,
+               'generated': generated_puzzles(args.generated, seed=args.seed)}
+    for path in args.corpus:
+        with open(path) as file:
+            corpora[os.path.basename(path)] = [sudoku.fingerprint() for sudoku in read_puzzles(file)]
+    report = benchmark(corpora, args.repeat, not args.no_memory)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(report, baseline, args.threshold)
+        for phase, old, new in regressions:
+            print(f'{phase}: p50 {old} ms -> {new} ms', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,333 @@
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+from itertools import permutations
+
+from sudoku import SYMBOL_VALUES, SYMBOLS, TEX_VERSION
+
+
+# The 1296 orders of the columns that keep stacks together, as tuples of
+# (stack, order within the stack) for each stack, and the same orders as
+# tuples of the 9 columns
+STACK_ORDERS = tuple((s0, p0, s1, p1, s2, p2)
+                     for s0, s1, s2 in permutations(range(3))
+                     for p0 in range(6) for p1 in range(6) for p2 in range(6))
+TRIPLES = tuple(permutations(range(3)))
+COLUMN_ORDERS = tuple(tuple(3 * s + k for s, p in ((o[0], o[1]), (o[2], o[3]), (o[4], o[5])) for k in TRIPLES[p])
+                      for o in STACK_ORDERS)
+# Canonical searches with more partial transforms than this are abandoned
+MAX_STATES = 5000
+permuted_masks = []
+
+
+def permuted_mask_table():
+    # permuted_mask_table()[k][m] is the pattern mask m of a row (bit 8 - j
+    # for column j) after putting its columns in COLUMN_ORDERS[k]. Built on
+    # first use.
+    if not permuted_masks:
+        triple = [[sum(((m >> (2 - p[k])) & 1) << (2 - k) for k in range(3)) for m in range(8)] for p in TRIPLES]
+        for s0, p0, s1, p1, s2, p2 in STACK_ORDERS:
+            t0, t1, t2 = triple[p0], triple[p1], triple[p2]
+            h0, h1, h2 = 6 - 3 * s0, 6 - 3 * s1, 6 - 3 * s2
+            permuted_masks.append([t0[m >> h0 & 7] << 6 | t1[m >> h1 & 7] << 3 | t2[m >> h2 & 7]
+                                   for m in range(512)])
+    return permuted_masks
+
+
+def canonical_form(values):
+    # Smallest representative of the puzzle (a list of 81 values, 0 for an
+    # empty cell) under transposition, reordering of bands, of stacks, of
+    # rows within a band and of columns within a stack, and relabelling of
+    # the digits. Puzzles are compared first on their pattern of empty cells,
+    # row by row, then on their digits relabelled in order of appearance.
+    # Returns the 81-digit string and the transform (transposed, row order,
+    # column order, digit map) that produced it, or None, None when the
+    # puzzle is so symmetric that the search would be too long, or is not
+    # a 9 x 9 puzzle.
+    if len(values) != 81:
+        return None, None
+    table = permuted_mask_table()
+    grids = (tuple(tuple(values[9 * i:9 * i + 9]) for i in range(9)),
+             tuple(tuple(values[i::9]) for i in range(9)))
+    masks = tuple(tuple(sum(1 << (8 - j) for j in range(9) if row[j]) for row in grid) for grid in grids)
+    states = [(t, (), range(len(COLUMN_ORDERS))) for t in (0, 1)]
+    for position in range(9):
+        best = None
+        best_states = []
+        for t, rows, orders in states:
+            if position % 3:
+                band = rows[-1] // 3
+                choices = [r for r in range(3 * band, 3 * band + 3) if r not in rows]
+            else:
+                used = {r // 3 for r in rows}
+                choices = [r for r in range(9) if r // 3 not in used]
+            seen = set()
+            for r in choices:
+                # Identical rows of a band lead to the same results
+                if (r // 3, grids[t][r]) in seen:
+                    continue
+                seen.add((r // 3, grids[t][r]))
+                m = masks[t][r]
+                low = min(table[k][m] for k in orders)
+                if best is None or low < best:
+                    best = low
+                    best_states = []
+                if low == best:
+                    best_states.append((t, rows + (r,), [k for k in orders if table[k][m] == low]))
+        states = best_states
+        if sum(len(orders) for _, _, orders in states) > MAX_STATES * 9:
+            return None, None
+    best = None
+    transform = None
+    for t, rows, orders in states:
+        grid = grids[t]
+        for k in orders:
+            columns = COLUMN_ORDERS[k]
+            mapping = [0] * 10
+            label = 0
+            out = []
+            for r in rows:
+                row = grid[r]
+                for j in columns:
+                    v = row[j]
+                    if v and not mapping[v]:
+                        label += 1
+                        mapping[v] = label
+                    out.append(mapping[v])
+            if best is None or out < best:
+                best = out
+                transform = (t, rows, columns, mapping)
+    t, rows, columns, mapping = transform
+    # Digits missing from the puzzle take the remaining labels in order
+    label = max(mapping)
+    for v in range(1, 10):
+        if not mapping[v]:
+            label += 1
+            mapping[v] = label
+    return ''.join(map(str, best)), (t, rows, columns, tuple(mapping))
+
+
+def exact_key(values):
+    # Key of the puzzle itself: its symbols cell by cell after a '=', which
+    # canonical forms, all digits, never start with
+    return '=' + ''.join(SYMBOLS[num] for num in values)
+
+
+def from_canonical(values, transform):
+    # Maps 81 values in the canonical frame (such as the solution of the
+    # canonical puzzle) back to the frame of the puzzle the transform is for
+    t, rows, columns, mapping = transform
+    inverse = [0] * 10
+    for v in range(1, 10):
+        inverse[mapping[v]] = v
+    out = [0] * 81
+    for i, r in enumerate(rows):
+        for k, j in enumerate(columns):
+            cell = 9 * j + r if t else 9 * r + j
+            out[cell] = inverse[int(values[9 * i + k])]
+    return out
+
+
+class RenderCache:
+    # On-disk cache of LaTeX documents, one file per document, named after
+    # a hash of the state of the Sudoku (grid, candidates and canceled
+    # digits), the output mode and TEX_VERSION. When the files take more
+    # than max_bytes, the least recently used ones are deleted.
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, sudoku, mode):
+        # The candidates and canceled digits matter once some work is done,
+        # the documents being rendered from them
+        text = ':'.join([sudoku.fingerprint(), ','.join(map(str, sudoku.candidates)),
+                         ','.join(map(str, sudoku.canceled)), mode, str(TEX_VERSION)])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.tex')
+
+    def lookup(self, key):
+        # Path of the cached document, or None
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def render(self, sudoku, mode):
+        # The document of sudoku for mode, from the cache when possible
+        key = self.key(sudoku, mode)
+        path = self.lookup(key)
+        if path is not None:
+            try:
+                with open(path) as file:
+                    return file.read()
+            except FileNotFoundError:
+                pass
+        sudoku.prepare(mode)
+        buffer = io.StringIO()
+        sudoku.write_tex(buffer, mode)
+        text = buffer.getvalue()
+        self.store(key, text)
+        return text
+
+    def tex_output(self, sudoku, mode, filename):
+        path = self.lookup(self.key(sudoku, mode))
+        if path is not None:
+            try:
+                shutil.copyfile(path, filename)
+                return
+            except FileNotFoundError:
+                pass
+        text = self.render(sudoku, mode)
+        with open(filename, 'w') as file:
+            file.write(text)
+
+    def store(self, key, text):
+        # Written to a temporary file first so that concurrent readers never
+        # see a partial document
+        descriptor, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(descriptor, 'w') as file:
+            file.write(text)
+        os.replace(temp, self.path(key))
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.entries())
+        else:
+            self.size += os.path.getsize(self.path(key))
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.tex'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        # Deletes the least recently used documents down to 3/4 of max_bytes
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        self.size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        for path, _, _ in list(self.entries()):
+            os.remove(path)
+        self.size = 0
+
+
+class SolutionCache:
+    # Persistent SQLite cache of solutions keyed by the puzzle itself and,
+    # with canonical, by its canonical form too, so that a puzzle is solved
+    # once for all the puzzles equivalent to it. A canonical form costs some
+    # milliseconds, more than solving most puzzles, so it is only worth it
+    # for puzzles much harder than the usual ones. Keeps the max_entries most
+    # recently used keys. Writes, and the use times of the hits, are only
+    # committed every batch of them and by flush() and close().
+    def __init__(self, path, max_entries=1000000, canonical=False, batch=256):
+        self.max_entries = max_entries
+        self.canonical = canonical
+        self.batch = batch
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS solutions '
+                                '(puzzle TEXT PRIMARY KEY, solution TEXT, used INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS solutions_used ON solutions (used)')
+        self.clock = self.connection.execute('SELECT COALESCE(MAX(used), 0) FROM solutions').fetchone()[0]
+        self.count = self.connection.execute('SELECT COUNT(*) FROM solutions').fetchone()[0]
+        # Use times of the keys hit since the last flush, and the number of
+        # writes not committed yet
+        self.used = {}
+        self.pending = 0
+
+    def get(self, key):
+        row = self.connection.execute('SELECT solution FROM solutions WHERE puzzle = ?', (key,)).fetchone()
+        if row is not None:
+            self.clock += 1
+            self.used[key] = self.clock
+            if len(self.used) >= self.batch:
+                self.flush()
+        return row
+
+    def lookup(self, values):
+        # (True, solution as values cell by cell) or (True, None) for a
+        # puzzle known to have no solution, (False, None) when the puzzle is
+        # not cached. The puzzle itself is looked up first, its canonical
+        # form only when that fails.
+        row = self.get(exact_key(values))
+        if row is not None:
+            return True, [SYMBOL_VALUES[symbol] for symbol in row[0]] or None
+        if not self.canonical:
+            return False, None
+        puzzle, transform = canonical_form(values)
+        if puzzle is None:
+            return False, None
+        row = self.get(puzzle)
+        if row is None:
+            return False, None
+        if not row[0]:
+            return True, None
+        return True, from_canonical(row[0], transform)
+
+    def store(self, values, solution):
+        # solution is None for a puzzle without solution
+        rows = [(exact_key(values), '' if solution is None else ''.join(SYMBOLS[num] for num in solution))]
+        if self.canonical:
+            puzzle, transform = canonical_form(values)
+            if puzzle is not None:
+                if solution is None:
+                    text = ''
+                else:
+                    # Into the canonical frame
+                    t, order, columns, mapping = transform
+                    grid = solution if not t else [solution[9 * j + i] for i in range(9) for j in range(9)]
+                    text = ''.join(str(mapping[grid[9 * r + j]]) for r in order for j in columns)
+                rows.append((puzzle, text))
+        for key, text in rows:
+            self.clock += 1
+            # Only new keys count towards max_entries
+            inserted = self.connection.execute('INSERT OR IGNORE INTO solutions VALUES (?, ?, ?)',
+                                               (key, text, self.clock)).rowcount
+            if inserted:
+                self.count += inserted
+            else:
+                self.connection.execute('UPDATE solutions SET solution = ?, used = ? WHERE puzzle = ?',
+                                        (text, self.clock, key))
+            self.used.pop(key, None)
+        self.pending += 1
+        if self.pending >= self.batch:
+            self.flush()
+
+    def flush(self):
+        # Writes the use times of the hits, evicts the least recently used
+        # keys beyond max_entries and commits
+        if self.used:
+            self.connection.executemany('UPDATE solutions SET used = ? WHERE puzzle = ?',
+                                        [(used, key) for key, used in self.used.items()])
+            self.used.clear()
+        if self.count > self.max_entries:
+            self.connection.execute('DELETE FROM solutions WHERE puzzle IN '
+                                    '(SELECT puzzle FROM solutions ORDER BY used LIMIT ?)',
+                                    (self.count - self.max_entries,))
+            self.count = self.connection.execute('SELECT COUNT(*) FROM solutions').fetchone()[0]
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,204 @@
+from functools import lru_cache
+
+from sudoku import BOX_SIZES, NODES, BudgetExceeded, Sudoku, SudokuError, layout_for
+
+
+class DancingLinks:
+    # Algorithm X on the exact cover matrix of a board: a column for each
+    # cell, each (row, digit), (column, digit) and (box, digit), and a row of
+    # four nodes for each digit in each cell. The matrix is built once in
+    # flat arrays of links, which are restored in place for every puzzle.
+    # Node 0 is the root, nodes 1..4 * size ** 2 the column headers.
+    def __init__(self, box_size=3):
+        layout = layout_for(box_size)
+        n = layout.size
+        self.layout = layout
+        columns = 4 * n * n
+        total = 1 + columns + 4 * n * n * n
+        left = [0] * total
+        right = [0] * total
+        up = list(range(total))
+        down = list(range(total))
+        self.column = [0] * total
+        # Cell and digit of the matrix row of each node
+        self.cell = [0] * total
+        self.digit = [0] * total
+        # First node of the row of digit d in cell c, at c * size + d - 1
+        self.first = [0] * (n * n * n)
+        for h in range(columns + 1):
+            left[h] = h - 1
+            right[h] = h + 1
+        left[0] = columns
+        right[columns] = 0
+        size = [0] * (columns + 1)
+        node = columns + 1
+        for c in layout.cells:
+            i, j, b = layout.row_of[c], layout.column_of[c], layout.box_of[c]
+            for d in range(n):
+                self.first[c * n + d] = node
+                heads = (1 + c, 1 + n * n + i * n + d, 1 + 2 * n * n + j * n + d, 1 + 3 * n * n + b * n + d)
+                for k, h in enumerate(heads):
+                    self.column[node] = h
+                    self.cell[node] = c
+                    self.digit[node] = d + 1
+                    up[node] = up[h]
+                    down[node] = h
+                    down[up[h]] = node
+                    up[h] = node
+                    size[h] += 1
+                    left[node] = node - 1 if k else node + 3
+                    right[node] = node + 1 if k < 3 else node - 3
+                    node += 1
+        self.left, self.right, self.up, self.down, self.size = left, right, up, down, size
+        self.pristine = (left[:], right[:], up[:], down[:], size[:])
+        self.chosen = []
+        self.solution = None
+        self.nodes = 0
+        self.max_nodes = None
+        self.budget = None
+
+    def load(self, values):
+        # Restores the matrix and selects the rows of the given digits.
+        # Returns False when two givens share a column, that is when the
+        # puzzle breaks a rule.
+        self.left[:], self.right[:], self.up[:], self.down[:], self.size[:] = self.pristine
+        del self.chosen[:]
+        self.solution = None
+        self.nodes = 0
+        n = self.layout.size
+        left, right = self.left, self.right
+        for c, num in enumerate(values):
+            if num:
+                row = self.first[c * n + num - 1]
+                j = row
+                while True:
+                    h = self.column[j]
+                    if right[left[h]] != h:
+                        return False
+                    self.cover(h)
+                    j = right[j]
+                    if j == row:
+                        break
+        return True
+
+    def cover(self, h):
+        left, right, up, down, column, size = self.left, self.right, self.up, self.down, self.column, self.size
+        right[left[h]] = right[h]
+        left[right[h]] = left[h]
+        i = down[h]
+        while i != h:
+            j = right[i]
+            while j != i:
+                down[up[j]] = down[j]
+                up[down[j]] = up[j]
+                size[column[j]] -= 1
+                j = right[j]
+            i = down[i]
+
+    def uncover(self, h):
+        left, right, up, down, column, size = self.left, self.right, self.up, self.down, self.column, self.size
+        i = up[h]
+        while i != h:
+            j = left[i]
+            while j != i:
+                size[column[j]] += 1
+                down[up[j]] = j
+                up[down[j]] = j
+                j = left[j]
+            i = up[i]
+        right[left[h]] = h
+        left[right[h]] = h
+
+    def search(self, limit, values):
+        # Number of solutions, counting up to limit; the first one found is
+        # kept in solution
+        right, down, size = self.right, self.down, self.size
+        if right[0] == 0:
+            if self.solution is None:
+                self.solution = list(values)
+                for node in self.chosen:
+                    self.solution[self.cell[node]] = self.digit[node]
+            return 1
+        # The column with the fewest rows left
+        h = right[0]
+        best = size[h]
+        j = right[h]
+        while j != 0 and best > 1:
+            if size[j] < best:
+                h, best = j, size[j]
+            j = right[j]
+        if best == 0:
+            return 0
+        self.cover(h)
+        count = 0
+        row = down[h]
+        while row != h and count < limit:
+            self.nodes += 1
+            if self.max_nodes is not None and self.nodes > self.max_nodes:
+                raise BudgetExceeded(NODES)
+            if self.budget is not None:
+                self.budget.step()
+            self.chosen.append(row)
+            j = right[row]
+            while j != row:
+                self.cover(self.column[j])
+                j = right[j]
+            count += self.search(limit - count, values)
+            j = self.left[row]
+            while j != row:
+                self.uncover(self.column[j])
+                j = self.left[j]
+            self.chosen.pop()
+            row = down[row]
+        self.uncover(h)
+        return count
+
+    def count_solutions(self, puzzle, limit=2, max_nodes=None, budget=None):
+        # Number of solutions of the puzzle (a Sudoku or its values cell by
+        # cell), stopping as soon as limit of them are found: with limit=2,
+        # 0 means no solution, 1 a unique one and 2 several. The first
+        # solution found is left in solution. Gives up with a BudgetExceeded
+        # after max_nodes rows tried, if given, or when the budget (see
+        # sudoku.Budget), spent one step per row tried, runs out.
+        values = puzzle.values if isinstance(puzzle, Sudoku) else puzzle
+        if len(values) != len(self.layout.cells):
+            raise SudokuError('Incorrect length: ' + str(len(values)) + ' values')
+        n = self.layout.size
+        if any(not 0 <= num <= n for num in values):
+            raise SudokuError('Incorrect input: values must be between 0 and ' + str(n))
+        self.max_nodes = max_nodes
+        self.budget = budget
+        if not self.load(values):
+            return 0
+        return self.search(limit, values)
+
+    def solve(self, puzzle, max_nodes=None, budget=None):
+        # The values of a solution of the puzzle, or None
+        self.count_solutions(puzzle, 1, max_nodes, budget)
+        return self.solution
+
+
+@lru_cache(maxsize=None)
+def engine_for(box_size):
+    # One engine per board size and process, reused for every puzzle
+    return DancingLinks(box_size)
+
+
+def box_size_of(puzzle):
+    # Box size of a Sudoku, or of a board from the number of its values
+    if isinstance(puzzle, Sudoku):
+        return puzzle.layout.box_size
+    for box_size in BOX_SIZES:
+        if len(puzzle) == box_size ** 4:
+            return box_size
+    raise SudokuError('Incorrect length: ' + str(len(puzzle)) + ' values')
+
+
+def count_solutions(puzzle, limit=2, max_nodes=None, budget=None):
+    # count_solutions() of the engine for the size of the puzzle (a Sudoku,
+    # or its values cell by cell on a board of any of BOX_SIZES)
+    return engine_for(box_size_of(puzzle)).count_solutions(puzzle, limit, max_nodes, budget)
+
+
+def has_unique_solution(puzzle, max_nodes=None, budget=None):
+    return count_solutions(puzzle, 2, max_nodes, budget) == 1
@@ -0,0 +1,153 @@
+import argparse
+import os
+import random
+import sys
+from functools import partial
+from multiprocessing import Pool
+
+from sudoku import SYMBOLS, Sudoku, layout_for
+from sudoku_dlx import engine_for
+
+
+# Techniques a puzzle needs, easiest first: force() alone fills it, then
+# force() with get_marked() and naked singles, then worked() with its
+# preemptive sets, and last a search
+RATINGS = ('forced', 'marked', 'worked', 'search')
+
+
+def full_grid(rng, box_size=3):
+    # A random solved board: random digits in the boxes of the diagonal,
+    # which do not constrain each other, completed by the exact cover engine
+    # and then relabelled at random. Some fillings of the diagonal cannot be
+    # completed (often on 4 x 4 boards); they are drawn again.
+    layout = layout_for(box_size)
+    n = layout.size
+    values = None
+    while values is None:
+        values = [0] * (n * n)
+        for k in range(box_size):
+            box = layout.boxes[k * box_size + k]
+            for c, num in zip(box, rng.sample(range(1, n + 1), n)):
+                values[c] = num
+        values = engine_for(box_size).solve(values)
+    relabel = [0] + rng.sample(range(1, n + 1), n)
+    return [relabel[num] for num in values]
+
+
+def remove_clues(values, rng, box_size=3, clues=None, symmetric=False):
+    # Empties the cells of a solved board in random order as long as the
+    # solution stays unique, down to clues cells if given. With symmetric,
+    # cells are emptied with their image through the centre. A cell whose
+    # peers hold every other digit is emptied without a search.
+    engine = engine_for(box_size)
+    layout = layout_for(box_size)
+    puzzle = list(values)
+    last = len(puzzle) - 1
+    left = len(puzzle)
+    for c in rng.sample(range(len(puzzle)), len(puzzle)):
+        if clues is not None and left <= clues:
+            break
+        cells = {c, last - c} if symmetric else {c}
+        if not all(puzzle[x] for x in cells):
+            continue
+        for x in cells:
+            puzzle[x] = 0
+        if all(len({puzzle[p] for p in layout.peers[x]} - {0}) == layout.size - 1 for x in cells) \
+                or engine.count_solutions(puzzle, 2) == 1:
+            left -= len(cells)
+        else:
+            for x in cells:
+                puzzle[x] = values[x]
+    return puzzle
+
+
+def rate(puzzle, box_size=3):
+    # The first of RATINGS whose techniques fill the puzzle
+    n = box_size * box_size
+    sudoku = Sudoku.from_rows([puzzle[i:i + n] for i in range(0, n * n, n)])
+    sudoku.force()
+    if sudoku.is_finished():
+        return 'forced'
+    sudoku.get_marked()
+    sudoku.place_singletons()
+    if sudoku.is_finished():
+        return 'marked'
+    sudoku.worked()
+    if sudoku.is_finished():
+        return 'worked'
+    return 'search'
+
+
+def generate_one(index, seed=0, box_size=3, clues=None, symmetric=False, difficulty=None, rated=False):
+    # Puzzle number index of the run with seed, as (index, puzzle, rating),
+    # rating being None unless rated. Every puzzle has a generator of its
+    # own, seeded from seed and index, so that a run gives the same puzzles
+    # whatever the number of processes. With a difficulty, boards are drawn
+    # until a puzzle has that rating.
+    rng = random.Random(f'{seed}:{index}')
+    while True:
+        puzzle = remove_clues(full_grid(rng, box_size), rng, box_size, clues, symmetric)
+        rating = rate(puzzle, box_size) if difficulty is not None or rated else None
+        if difficulty is None or rating == difficulty:
+            return index, puzzle, rating
+
+
+def generate(count, seed=0, box_size=3, clues=None, symmetric=False, difficulty=None,
+             rated=False, processes=None, chunksize=16):
+    # Yields (index, puzzle, rating) for count new puzzles with a unique
+    # solution, in order, generated on a pool of processes (one per core by
+    # default, none with processes=1)
+    work = partial(generate_one, seed=seed, box_size=box_size, clues=clues,
+                   symmetric=symmetric, difficulty=difficulty, rated=rated)
+    if processes == 1:
+        yield from map(work, range(count))
+        return
+    with Pool(processes) as pool:
+        yield from pool.imap(work, range(count), chunksize)
+
+
+def format_puzzle(puzzle, box_size=3, rating=None):
+    # The layout of sudoku_N.txt: a line of digits (or letters from A for
+    # 10 on) per row, 0 for the empty cells, after a comment line with the
+    # rating if there is one
+    n = box_size * box_size
+    head = '' if rating is None else '# rating: ' + rating + '\n'
+    return head + ''.join(''.join(SYMBOLS[num] for num in puzzle[i:i + n]) + '\n' for i in range(0, n * n, n))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate puzzles with a unique solution.')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--box-size', type=int, default=3, choices=[2, 3, 4, 5])
+    parser.add_argument('--clues', type=int, help='stop emptying cells at this many clues')
+    parser.add_argument('--symmetric', action='store_true', help='empty cells in pairs through the centre')
+    parser.add_argument('--difficulty', choices=RATINGS, help='only keep puzzles with this rating')
+    parser.add_argument('--rated', action='store_true', help='write the rating of each puzzle before it')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--output', help='write all the puzzles to this file, separated by blank lines')
+    parser.add_argument('--directory', help='write each puzzle to NAME_N.txt in this directory')
+    parser.add_argument('--name', default='sudoku')
+    args = parser.parse_args(argv)
+
+    generated = generate(args.count, args.seed, args.box_size, args.clues, args.symmetric,
+                         args.difficulty, args.rated, args.processes)
+    if args.directory:
+        os.makedirs(args.directory, exist_ok=True)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for index, puzzle, rating in generated:
+            text = format_puzzle(puzzle, args.box_size, rating)
+            if args.directory:
+                with open(os.path.join(args.directory, args.name + '_' + str(index + 1) + '.txt'), 'w') as file:
+                    file.write(text)
+            else:
+                out.write(text + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import numpy as np
+
+import sudoku_batch
+from sudoku import ALL_DIGITS, Sudoku, UNIT_IDS_OF, UNIT_TYPES, UNITS
+
+
+UNIT_CELLS = np.array(UNITS, dtype=np.intp)
+CELL_UNITS = np.array(UNIT_IDS_OF, dtype=np.intp)
+POPCOUNT = np.array([m.bit_count() for m in range(ALL_DIGITS + 1)], dtype=np.uint8)
+# Digit of each single-bit mask, 0 for the other masks
+BIT_DIGIT = np.zeros(ALL_DIGITS + 1, dtype=np.uint8)
+BIT_DIGIT[[1 << (num - 1) for num in range(1, 10)]] = np.arange(1, 10)
+
+# Status of each puzzle after propagate_batch()
+OPEN = 0
+SOLVED = 1
+UNSOLVABLE = 2
+INVALID = 3
+
+
+def as_array(puzzles):
+    # Stacks the puzzles (Sudoku objects, 9 x 9 grids or rows of 81 values)
+    # into an (N, 9, 9) uint8 array. Only 9 x 9 puzzles are batched here;
+    # larger boards go through Sudoku one at a time.
+    if isinstance(puzzles, np.ndarray):
+        return puzzles.astype(np.uint8, copy=False).reshape(-1, 9, 9)
+    grids = [p.grid if isinstance(p, Sudoku) else p for p in puzzles]
+    return np.asarray(grids, dtype=np.uint8).reshape(-1, 9, 9)
+
+
+def unit_view(grids):
+    # (N, 27, 9) view of the cells of every row, column and box, in the
+    # order of UNITS
+    n = grids.shape[0]
+    boxes = grids.reshape(n, 3, 3, 3, 3).transpose(0, 1, 3, 2, 4).reshape(n, 9, 9)
+    return np.concatenate((grids, grids.transpose(0, 2, 1), boxes), axis=1)
+
+
+def digit_bits(grids):
+    # Digit d as the one-hot bit 1 << (d - 1), empty cells and values out of
+    # 1..9 as 0
+    grids = np.where(grids <= 9, grids, 0).astype(np.uint16)
+    return np.left_shift(np.uint16(1), grids) >> 1
+
+
+def validate_batch(puzzles):
+    # Vectorised preassess over N puzzles at once. A unit has a duplicate
+    # digit exactly when the sum of the one-hot bits of its cells differs
+    # from their union. Returns a boolean array of verdicts (True when there
+    # might be a solution) and an int array with the index in UNITS of the
+    # first bad unit of each puzzle, -1 for the good ones. A value out of
+    # 0..9 makes its row bad.
+    grids = as_array(puzzles)
+    bits = unit_view(digit_bits(grids))
+    bad = bits.sum(axis=2, dtype=np.uint16) != np.bitwise_or.reduce(bits, axis=2)
+    bad[:, :9] |= (grids > 9).any(axis=2)
+    verdict = ~bad.any(axis=1)
+    unit = np.where(verdict, -1, bad.argmax(axis=1))
+    return verdict, unit
+
+
+def describe_unit(u):
+    return UNIT_TYPES[u] + ' ' + str(u % 9 + 1)
+
+
+def propagate_batch(puzzles):
+    # The peer elimination of get_marked() with the naked singles and the
+    # hidden singles of force() and solve(), applied to all puzzles at once
+    # until none of them changes. Returns the (N, 9, 9) grids, the (N, 81)
+    # candidate masks (0 for the nonempty cells) and the status of each
+    # puzzle: SOLVED, UNSOLVABLE (a contradiction was met), INVALID (a value
+    # out of 0..9) or OPEN (singles are not enough).
+    values = as_array(puzzles).reshape(-1, 81).copy()
+    n = values.shape[0]
+    status = np.full(n, OPEN, dtype=np.int8)
+    status[(values > 9).any(axis=1)] = INVALID
+    candidates = np.where(values == 0, ALL_DIGITS, 0).astype(np.uint16)
+    active = np.flatnonzero(status == OPEN)
+    while active.size:
+        v = values[active]
+        unit_bits = digit_bits(v)[:, UNIT_CELLS]
+        placed = np.bitwise_or.reduce(unit_bits, axis=2)
+        dead = (unit_bits.sum(axis=2, dtype=np.uint16) != placed).any(axis=1)
+        # Peer elimination
+        used = np.bitwise_or.reduce(placed[:, CELL_UNITS], axis=2)
+        cand = candidates[active] & ~used
+        empty = v == 0
+        cand[~empty] = 0
+        count = POPCOUNT[cand]
+        dead |= (empty & (count == 0)).any(axis=1)
+        # Hidden singles: digits that fit in only one cell of a unit
+        unit_cand = cand[:, UNIT_CELLS]
+        once = np.zeros(placed.shape, dtype=np.uint16)
+        twice = np.zeros(placed.shape, dtype=np.uint16)
+        for k in range(9):
+            twice |= once & unit_cand[:, :, k]
+            once |= unit_cand[:, :, k]
+        dead |= ((once | placed) != ALL_DIGITS).any(axis=1)
+        hidden = cand & np.bitwise_or.reduce((once & ~twice)[:, CELL_UNITS], axis=2)
+        dead |= (POPCOUNT[hidden] > 1).any(axis=1)
+        # Naked singles, then hidden singles
+        single = np.where(count == 1, cand, hidden)
+        assigned = single != 0
+        changed = assigned.any(axis=1) & ~dead
+        v[assigned] = BIT_DIGIT[single[assigned]]
+        values[active[changed]] = v[changed]
+        candidates[active] = np.where(assigned, 0, cand)
+        status[active[dead]] = UNSOLVABLE
+        done = active[~changed & ~dead]
+        status[done[(values[done] != 0).all(axis=1)]] = SOLVED
+        active = active[changed]
+    return values.reshape(-1, 9, 9), candidates, status
+
+
+def solve_batch_numpy(puzzles, max_nodes=100000):
+    # Like sudoku_batch.solve_batch() in one process: propagate_batch() does
+    # the bulk of the work and only the puzzles it leaves open are built as
+    # Sudoku objects and searched.
+    values, candidates, status = propagate_batch(puzzles)
+    results = []
+    for index in range(len(status)):
+        if status[index] == SOLVED:
+            results.append(sudoku_batch.BatchResult(index, sudoku_batch.SOLVED, values[index].tolist(), ''))
+        elif status[index] == UNSOLVABLE:
+            results.append(sudoku_batch.BatchResult(index, sudoku_batch.UNSOLVABLE, None, 'There is no solution.'))
+        elif status[index] == INVALID:
+            results.append(sudoku_batch.BatchResult(index, sudoku_batch.INVALID, None, 'Incorrect input'))
+        else:
+            sudoku = Sudoku.from_rows(values[index].tolist())
+            for c in np.flatnonzero(candidates[index]):
+                sudoku.candidates[c] = int(candidates[index, c])
+            results.append(sudoku_batch.solve_sudoku(index, sudoku, max_nodes))
+    return results
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from sudoku import Budget, BudgetExceeded, DONE, Sudoku, SudokuError, digits_of
+from sudoku_dlx import count_solutions
+
+
+OPERATIONS = ('preassess', 'forced', 'marked', 'worked', 'solve')
+
+
+def load_request_puzzle(puzzle):
+    # The text of a grid, as in the input files or on one line, or a list
+    # of rows, each a string or a list of numbers or strings
+    if isinstance(puzzle, str):
+        return Sudoku.from_string(puzzle)
+    if isinstance(puzzle, list) and puzzle and all(
+            isinstance(row, str) or isinstance(row, list) and all(
+                isinstance(cell, str) or isinstance(cell, int) and not isinstance(cell, bool) for cell in row)
+            for row in puzzle):
+        return Sudoku.from_rows(puzzle)
+    raise SudokuError('Incorrect input')
+
+
+def respond(request, max_nodes=100000, seconds=None):
+    # The response to a request {"id": ..., "op": ..., "puzzle": ...,
+    # "latex": false, "seconds": ..., "step": ...}: the grid after the
+    # operation, the candidates and canceled digits of each cell as lists of
+    # digits row by row, and the LaTeX document of the state when asked for.
+    # An operation cut short by its time budget (the least of seconds and
+    # that of the request) or by max_nodes answers with the state it reached
+    # and its reason.
+    # With a step, the state is the one after that many steps of the work,
+    # replayed from its journal, and steps tells how many there are.
+    op = request.get('op', 'worked')
+    if op not in OPERATIONS:
+        raise SudokuError('Unknown operation ' + str(op))
+    sudoku = load_request_puzzle(request.get('puzzle'))
+    response = {'id': request.get('id'), 'op': op, 'ok': True}
+    mode = 'bare'
+    limits = [t for t in (seconds, request.get('seconds')) if isinstance(t, (int, float))]
+    budget = Budget(min(limits)) if limits else None
+    if op == 'preassess':
+        possible = sudoku.check_row() and sudoku.check_column() and sudoku.check_grid()
+        response['possible'] = possible
+        # 0 for no solution, 1 for a unique one, 2 for several, None when
+        # the count was cut short
+        response['reason'] = DONE
+        try:
+            response['solutions'] = count_solutions(sudoku, 2, max_nodes, budget) if possible else 0
+        except BudgetExceeded as e:
+            response['reason'] = e.reason
+            response['solutions'] = None
+    else:
+        response['reason'] = sudoku.run(op, budget, max_nodes).reason
+        if op == 'solve':
+            response['solved'] = response['reason'] == DONE and sudoku.is_finished()
+        else:
+            mode = op
+        step = request.get('step')
+        if isinstance(step, int) and not isinstance(step, bool):
+            response['steps'] = len(sudoku.step_starts())
+            response['step'] = min(max(step, 0), response['steps'])
+            sudoku = sudoku.replay(response['step'])
+    response['grid'] = sudoku.grid
+    rows = sudoku.layout.rows
+    response['candidates'] = [[digits_of(sudoku.candidates[c]) for c in row] for row in rows]
+    response['canceled'] = [[digits_of(sudoku.canceled[c]) for c in row] for row in rows]
+    if request.get('latex'):
+        out = io.StringIO()
+        sudoku.write_tex(out, mode)
+        response['latex'] = out.getvalue()
+    return response
+
+
+def handle(line, max_nodes=100000, seconds=None):
+    # Runs in the worker processes: one line of JSON in, one line out
+    try:
+        request = json.loads(line)
+    except ValueError as e:
+        return json.dumps({'id': None, 'ok': False, 'error': 'Bad JSON: ' + str(e)})
+    if not isinstance(request, dict):
+        return json.dumps({'id': None, 'ok': False, 'error': 'A request is a JSON object'})
+    try:
+        response = respond(request, max_nodes, seconds)
+    except SudokuError as e:
+        response = {'id': request.get('id'), 'op': request.get('op'), 'ok': False, 'error': e.message}
+    return json.dumps(response)
+
+
+def request_id(line):
+    # The id of a request, or None when it cannot be read
+    try:
+        request = json.loads(line)
+    except ValueError:
+        return None
+    return request.get('id') if isinstance(request, dict) else None
+
+
+class LineReader:
+    # readline() of a blocking binary stream such as stdin, run in a thread
+    # so that it does not hold the event loop
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def readline(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.stream.readline)
+
+
+async def serve_stream(reader, write, executor, max_pending=64, max_nodes=100000, seconds=None):
+    # Reads requests from reader, one per line, hands them to the executor
+    # and writes each response with write() as soon as it is ready, so not
+    # necessarily in request order. No more line is read while max_pending
+    # requests are in flight, which pushes back on the client.
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(max_pending)
+    pending = set()
+    work = partial(handle, max_nodes=max_nodes, seconds=seconds)
+
+    async def run(line):
+        # A request whose worker failed is still answered
+        try:
+            try:
+                response = await loop.run_in_executor(executor, work, line)
+            except Exception as e:
+                response = json.dumps({'id': request_id(line), 'ok': False,
+                                       'error': 'Internal error: ' + type(e).__name__})
+            await write(response)
+        finally:
+            slots.release()
+
+    while True:
+        await slots.acquire()
+        line = await reader.readline()
+        if not line.strip():
+            slots.release()
+            if not line:
+                break
+            continue
+        task = asyncio.ensure_future(run(line))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.wait(pending)
+
+
+def stream_writer(writer):
+    async def write(text):
+        writer.write(text.encode() + b'\n')
+        await writer.drain()
+    return write
+
+
+async def write_stdout(text):
+    sys.stdout.write(text + '\n')
+    sys.stdout.flush()
+
+
+async def serve(tcp=None, unix=None, processes=None, max_pending=64, max_nodes=100000, seconds=None):
+    # Serves stdin and stdout, or every connection to a TCP address
+    # (host:port) or a Unix socket, on one pool of processes
+    with ProcessPoolExecutor(processes) as executor:
+        if tcp is None and unix is None:
+            await serve_stream(LineReader(sys.stdin.buffer), write_stdout, executor, max_pending, max_nodes, seconds)
+            return
+
+        # Start the workers before any socket is open: workers forked later
+        # would hold the connections open after the server closes them
+        await asyncio.get_running_loop().run_in_executor(executor, int)
+
+        async def connection(reader, writer):
+            try:
+                await serve_stream(reader, stream_writer(writer), executor, max_pending, max_nodes, seconds)
+            finally:
+                writer.close()
+
+        if tcp is not None:
+            host, _, port = tcp.rpartition(':')
+            server = await asyncio.start_server(connection, host or None, int(port))
+        else:
+            server = await asyncio.start_unix_server(connection, unix)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve JSON-lines Sudoku requests.')
+    parser.add_argument('--tcp', metavar='HOST:PORT', help='listen on a TCP address instead of stdin')
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of stdin')
+    parser.add_argument('--processes', type=int, help='worker processes, one per core by default')
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help='requests in flight per client before reading stops')
+    parser.add_argument('--max-nodes', type=int, default=100000, help='search budget of solve')
+    parser.add_argument('--seconds', type=float, help='time budget of each request')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.tcp, args.unix, args.processes, args.max_pending, args.max_nodes, args.seconds))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
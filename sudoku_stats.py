@@ -0,0 +1,110 @@
+import cProfile
+import io
+import logging
+import pstats
+import tracemalloc
+
+
+logger = logging.getLogger('sudoku')
+
+
+class Stats:
+    # Counters and timings of the techniques of a Sudoku, gathered while it
+    # is set as the stats attribute of the sudoku:
+    #
+    #     sudoku.stats = Stats(hooks=[log_hook])
+    #     sudoku.worked()
+    #     print(sudoku.stats.report())
+    #
+    # counts maps a name such as 'force.passes', 'preemptive.combinations',
+    # 'preemptive.naked.row' or 'eliminations.hidden_set' to a number, and
+    # calls and times map the name of a timed method to how many times it
+    # was called and the seconds spent in it, calls nested in it included.
+    # Every hook is called as hook(name, seconds, stats) when a timed method
+    # returns. With profile, the outermost timed calls are run under
+    # cProfile; with trace_memory, the peak memory of each outermost timed
+    # call is kept in peak_memory.
+    def __init__(self, hooks=(), profile=False, trace_memory=False):
+        self.counts = {}
+        self.calls = {}
+        self.times = {}
+        self.peak_memory = {}
+        self.hooks = list(hooks)
+        self.profiler = cProfile.Profile() if profile else None
+        self.trace_memory = trace_memory
+        self.depth = 0
+        self.started_tracing = False
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def enter(self, name):
+        if self.depth == 0:
+            if self.trace_memory:
+                self.started_tracing = not tracemalloc.is_tracing()
+                if self.started_tracing:
+                    tracemalloc.start()
+                tracemalloc.reset_peak()
+            if self.profiler is not None:
+                self.profiler.enable()
+        self.depth += 1
+
+    def leave(self, name, seconds):
+        self.depth -= 1
+        if self.depth == 0:
+            if self.profiler is not None:
+                self.profiler.disable()
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peak_memory[name] = max(self.peak_memory.get(name, 0), peak)
+                if self.started_tracing:
+                    tracemalloc.stop()
+        self.calls[name] = self.calls.get(name, 0) + 1
+        self.times[name] = self.times.get(name, 0.0) + seconds
+        for hook in self.hooks:
+            hook(name, seconds, self)
+
+    def reset(self):
+        self.counts.clear()
+        self.calls.clear()
+        self.times.clear()
+        self.peak_memory.clear()
+
+    def as_dict(self):
+        return {'counts': dict(self.counts),
+                'calls': dict(self.calls),
+                'times': dict(self.times),
+                'peak_memory': dict(self.peak_memory)}
+
+    def report(self, profile_lines=20):
+        # The counters and timings as text, most expensive methods first,
+        # followed by the top of the profile if there is one
+        lines = []
+        for name in sorted(self.times, key=self.times.get, reverse=True):
+            line = f'{name:<24}{self.calls[name]:>8} calls {self.times[name]:>12.6f} s'
+            if name in self.peak_memory:
+                line += f' {self.peak_memory[name] / 1024:>10.1f} KiB peak'
+            lines.append(line)
+        for name in sorted(self.counts):
+            lines.append(f'{name:<40}{self.counts[name]:>12}')
+        text = '\n'.join(lines) + '\n'
+        if self.profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(profile_lines)
+            text += out.getvalue()
+        return text
+
+
+def log_hook(name, seconds, stats):
+    # Logs every timed call at debug level on the 'sudoku' logger
+    logger.debug('%s took %.6f s', name, seconds)
+
+
+def slow_call_hook(threshold, log=logger):
+    # A hook that logs a warning, with the counters so far, whenever a timed
+    # call takes more than threshold seconds
+    def hook(name, seconds, stats):
+        if seconds > threshold:
+            log.warning('%s took %.3f s: %s', name, seconds,
+                        ', '.join(f'{k}={v}' for k, v in sorted(stats.counts.items())))
+    return hook